@@ -0,0 +1,343 @@
+"""In-process stand-ins for Keystone, Nova and the allocations API,
+serving a synthetic cloud.
+
+The fakes implement just enough of the client interfaces used by
+hivemind_contrib for its tasks to run unmodified against them.  Every
+call is counted per endpoint, and can be slowed down by a fixed latency
+to make the effect of concurrency visible.
+"""
+import collections
+import datetime
+import itertools
+import random
+import threading
+import time
+import uuid
+
+from keystoneclient import exceptions as keystone_exceptions
+from novaclient import exceptions as nova_exceptions
+
+
+AVAILABILITY_ZONES = ['melbourne-qh2', 'monash-01', 'QRIScloud', 'tasmania',
+                      'NCI', 'sa', 'intersect-01']
+TENANT_MANAGER_ROLE = '14'
+MEMBER_ROLE = '2'
+
+
+class CallCounter(object):
+    """Counts the calls made to each endpoint, thread-safely, sleeping
+    for latency seconds on each one.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def record(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+class FakeResource(object):
+    """A record with the same constructor and to_dict() as the client
+    libraries' resources.
+    """
+    def __init__(self, manager, info, loaded=False):
+        self.manager = manager
+        self._info = info
+        for key, value in info.items():
+            setattr(self, key, value)
+
+    def to_dict(self):
+        return dict(self._info)
+
+
+class FakeManager(object):
+    resource_class = FakeResource
+
+    def __init__(self, counter, endpoint, records, not_found):
+        self.counter = counter
+        self.endpoint = endpoint
+        self.records = records
+        self.by_id = dict((record.get('id'), record) for record in records)
+        self.not_found = not_found
+
+    def _call(self, method):
+        self.counter.record('%s %s' % (self.endpoint, method))
+
+    def _resource(self, info):
+        return self.resource_class(self, info, loaded=True)
+
+    def _matches(self, info, filters):
+        return all(info.get(key) == value for key, value in filters.items()
+                   if value is not None)
+
+    def list(self, **filters):
+        self._call('list')
+        return [self._resource(info) for info in self.records
+                if self._matches(info, filters)]
+
+    def get(self, id):
+        self._call('get')
+        if id not in self.by_id:
+            raise self.not_found()
+        return self._resource(self.by_id[id])
+
+    def find(self, **filters):
+        self._call('list')
+        for info in self.records:
+            if self._matches(info, filters):
+                return self._resource(info)
+        raise self.not_found()
+
+
+class FakeServerManager(FakeManager):
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None):
+        self._call('list')
+        search_opts = search_opts or {}
+        tenant_id = search_opts.get('project_id') or \
+            search_opts.get('tenant_id')
+        deleted = bool(search_opts.get('deleted'))
+        since = search_opts.get('changes-since')
+        servers = self.records
+        if marker is not None:
+            servers = itertools.islice(servers, self.index[marker] + 1, None)
+        page = []
+        for info in servers:
+            if tenant_id is not None and info['tenant_id'] != tenant_id:
+                continue
+            if since is not None:
+                # changes-since returns deleted servers as well
+                if info['updated'] < since or \
+                        (deleted and info['status'] != 'DELETED'):
+                    continue
+            elif (info['status'] == 'DELETED') != deleted:
+                continue
+            page.append(self._resource(info))
+            if limit is not None and len(page) >= limit:
+                break
+        return page
+
+    @property
+    def index(self):
+        if not hasattr(self, '_index'):
+            self._index = dict((info['id'], i)
+                               for i, info in enumerate(self.records))
+        return self._index
+
+
+class FakeFlavorManager(FakeManager):
+
+    def list(self, is_public=True):
+        self._call('list')
+        return [self._resource(info) for info in self.records
+                if info['os-flavor-access:is_public'] == is_public]
+
+
+class FakeQuotaManager(FakeManager):
+
+    def get(self, tenant_id):
+        self._call('get')
+        if tenant_id not in self.by_id:
+            raise self.not_found()
+        return self._resource(self.by_id[tenant_id])
+
+    def update(self, tenant_id, **quotas):
+        self._call('update')
+        self.by_id[tenant_id].update(quotas)
+        return self._resource(self.by_id[tenant_id])
+
+
+class FakeUsageManager(object):
+
+    def __init__(self, counter, servers):
+        self.counter = counter
+        self.servers = servers
+
+    def list(self, start, end, detailed=False):
+        self.counter.record('nova usage list')
+        usage = collections.OrderedDict()
+        hours = (end - start).total_seconds() / 3600
+        for server in self.servers:
+            u = usage.get(server['tenant_id'])
+            if u is None:
+                u = usage[server['tenant_id']] = FakeResource(None, {
+                    'tenant_id': server['tenant_id'],
+                    'total_hours': 0, 'total_vcpus_usage': 0,
+                    'total_memory_mb_usage': 0, 'total_local_gb_usage': 0,
+                    'server_usages': []})
+            flavor = server['flavor_info']
+            u.total_hours += hours
+            u.total_vcpus_usage += hours * flavor['vcpus']
+            u.total_memory_mb_usage += hours * flavor['ram']
+            u.total_local_gb_usage += hours * flavor['disk']
+            if detailed:
+                u.server_usages.append({
+                    'instance_id': server['id'],
+                    'name': server['name'],
+                    'state': 'terminated' if server['status'] == 'DELETED'
+                    else 'active',
+                    'flavor': flavor['name'],
+                    'hours': hours,
+                    'vcpus': flavor['vcpus'],
+                    'memory_mb': flavor['ram'],
+                    'local_gb': flavor['disk']})
+        return usage.values()
+
+
+class FakeNova(object):
+
+    def __init__(self, cloud, counter):
+        not_found = lambda: nova_exceptions.NotFound(404)
+        self.client = FakeResource(None, {'auth_url': cloud.auth_url})
+        self.flavors = FakeFlavorManager(counter, 'nova flavors',
+                                         cloud.flavors, not_found)
+        self.servers = FakeServerManager(counter, 'nova servers',
+                                         cloud.servers, not_found)
+        self.quotas = FakeQuotaManager(counter, 'nova quotas',
+                                       cloud.quotas, not_found)
+        self.usage = FakeUsageManager(counter, cloud.servers)
+
+
+class FakeRoleAssignmentManager(FakeManager):
+
+    def list(self, role=None, user=None, project=None, effective=False):
+        self._call('list')
+        role = getattr(role, 'id', role)
+        user = getattr(user, 'id', user)
+        project = getattr(project, 'id', project)
+        return [self._resource(info) for info in self.records
+                if (role is None or info['role']['id'] == str(role)) and
+                (user is None or info['user']['id'] == user) and
+                (project is None or
+                 info['scope']['project']['id'] == project)]
+
+
+class FakeKeystone(object):
+    version = 'v3'
+
+    def __init__(self, cloud, counter):
+        not_found = keystone_exceptions.NotFound
+        self.auth_url = cloud.auth_url
+        self.session = FakeResource(None, {
+            'auth': FakeResource(None, {'auth_url': cloud.auth_url})})
+        self.users = FakeManager(counter, 'keystone users', cloud.users,
+                                 not_found)
+        self.projects = FakeManager(counter, 'keystone projects',
+                                    cloud.projects, not_found)
+        self.roles = FakeManager(counter, 'keystone roles', cloud.roles,
+                                 not_found)
+        self.role_assignments = FakeRoleAssignmentManager(
+            counter, 'keystone role_assignments', cloud.role_assignments,
+            not_found)
+
+
+class FakeAllocationsApi(object):
+    """Stands in for reporting.NectarApiSession."""
+
+    def __init__(self, cloud, counter, page_size=1000):
+        self.counter = counter
+        self.allocations = cloud.allocations
+        self.page_size = page_size
+        self.auth = ('benchmark', 'benchmark')
+        self.api_url = cloud.auth_url + '/allocations'
+
+    def iter_allocations(self, modified_since=None):
+        records = [alloc for alloc in self.allocations
+                   if modified_since is None or
+                   alloc['modified_time'] >= modified_since]
+        for start in range(0, max(len(records), 1), self.page_size):
+            self.counter.record('allocations list')
+            for alloc in records[start:start + self.page_size]:
+                yield dict(alloc)
+
+    def get_allocations(self):
+        return list(self.iter_allocations())
+
+
+class Cloud(object):
+    """A synthetic cloud with the given numbers of tenants, servers and
+    users, generated deterministically from seed.  deleted is the
+    fraction of servers that have been deleted during the report window
+    that starts at start, and mismatched the fraction of allocated
+    tenants whose nova quotas differ from their allocation.
+    """
+    def __init__(self, tenants=100, servers=2000, users=500, flavors=30,
+                 deleted=0.2, mismatched=0.05, seed=0,
+                 start=datetime.datetime(2015, 1, 1)):
+        rand = random.Random(seed)
+        new_id = lambda: uuid.UUID(int=rand.getrandbits(128)).hex
+        self.auth_url = 'http://keystone.benchmark:5000/v3'
+        self.start = start
+
+        self.flavors = []
+        for i in range(flavors):
+            vcpus = 2 ** (i % 5)
+            self.flavors.append({
+                'id': str(i), 'name': 'flavor-%d' % i, 'vcpus': vcpus,
+                'ram': vcpus * 4096, 'disk': vcpus * 30,
+                'os-flavor-access:is_public': i % 10 != 9})
+
+        self.users = [{'id': new_id(), 'name': 'user-%d' % i,
+                       'email': 'user-%d@uni-%d.edu.au' % (i, i % 40)}
+                      for i in range(users)]
+        self.roles = [{'id': TENANT_MANAGER_ROLE, 'name': 'TenantManager'},
+                      {'id': MEMBER_ROLE, 'name': 'Member'}]
+
+        self.projects = []
+        self.role_assignments = []
+        self.allocations = []
+        self.quotas = []
+        for i in range(tenants):
+            project = {'id': new_id(), 'name': 'project-%d' % i,
+                       'description': 'Project %d' % i}
+            if rand.random() < 0.3:
+                project['allocation_home'] = 'uni-%d' % (i % 40)
+            self.projects.append(project)
+            for j, user in enumerate(rand.sample(self.users,
+                                                 min(len(self.users), 3))):
+                role = TENANT_MANAGER_ROLE if j == 0 else MEMBER_ROLE
+                self.role_assignments.append({
+                    'role': {'id': role}, 'user': {'id': user['id']},
+                    'scope': {'project': {'id': project['id']}}})
+
+            cores = rand.choice([2, 4, 8, 16, 32, 64])
+            alloc = {'id': len(self.allocations) + 1,
+                     'tenant_uuid': project['id'],
+                     'tenant_name': project['name'],
+                     'status': rand.choice(['A', 'A', 'A', 'X']),
+                     'modified_time': (start - datetime.timedelta(
+                         minutes=rand.randint(0, 500000))).isoformat(),
+                     'instance_quota': cores / 2, 'core_quota': cores,
+                     'ram_quota': cores * 4}
+            self.allocations.append(alloc)
+            quotas = {'id': project['id'],
+                      'instances': alloc['instance_quota'],
+                      'cores': alloc['core_quota'],
+                      'ram': alloc['ram_quota'] * 1024}
+            if rand.random() < mismatched:
+                quotas['cores'] += 2
+            self.quotas.append(quotas)
+
+        self.servers = []
+        for i in range(servers):
+            project = rand.choice(self.projects)
+            flavor = rand.choice(self.flavors)
+            gone = rand.random() < deleted
+            self.servers.append({
+                'id': new_id(), 'name': 'server-%d' % i,
+                'tenant_id': project['id'],
+                'status': 'DELETED' if gone else 'ACTIVE',
+                'flavor': {'id': flavor['id']},
+                'flavor_info': flavor,
+                'updated': (start + datetime.timedelta(
+                    minutes=rand.randint(0, 40000))).isoformat(),
+                'OS-EXT-AZ:availability_zone':
+                    rand.choice(AVAILABILITY_ZONES)})
@@ -0,0 +1,176 @@
+"""Run hivemind_contrib reporting tasks against a synthetic cloud and
+report how long they take, how much memory they use and how many API
+calls they make.
+
+    python -m benchmarks.run --tenants 10000 --servers 200000 --users 50000
+
+The cloud is generated once, and each task then runs in its own forked
+process with the Keystone, Nova and allocations API clients replaced by
+the fakes in benchmarks.fakes and an empty local cache (or, with
+--warm, one filled by running the task once beforehand).  Peak memory
+is the process's maximum resident set size, which includes the
+synthetic cloud itself; the growth column is the part due to the task.
+"""
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from prettytable import PrettyTable
+
+from benchmarks import fakes
+
+
+def _tasks(cloud, concurrency):
+    from hivemind_contrib import allocations
+    from hivemind_contrib import reporting
+
+    start = cloud.start.strftime('%Y-%m-%dT%H:%M')
+    end = (cloud.start + datetime.timedelta(days=30)).strftime(
+        '%Y-%m-%dT%H:%M')
+    return collections.OrderedDict([
+        ('crosscheck_usage',
+         lambda: allocations.crosscheck_usage(filename=os.devnull)),
+        ('crosscheck_quotas',
+         lambda: allocations.crosscheck_quotas(filename=os.devnull,
+                                               concurrency=concurrency)),
+        ('get_instance_usage_csv',
+         lambda: reporting.get_instance_usage_csv(start, end,
+                                                  filename=os.devnull,
+                                                  concurrency=concurrency)),
+        ('allocation_homes',
+         lambda: reporting.allocation_homes(csv=True, filename=os.devnull)),
+    ])
+
+
+def _install_fakes(cloud, counter):
+    """Point the client factories used by the tasks at the fakes."""
+    from hivemind_contrib import allocations
+    from hivemind_contrib import keystone
+    from hivemind_contrib import nova
+    from hivemind_contrib import reporting
+
+    nova_api = fakes.FakeNova(cloud, counter)
+    keystone_api = fakes.FakeKeystone(cloud, counter)
+    allocations_api = fakes.FakeAllocationsApi(cloud, counter)
+    nova.client = lambda *args, **kwargs: nova_api
+    keystone.client_session = lambda *args, **kwargs: keystone_api
+    reporting.api_session = lambda *args, **kwargs: allocations_api
+    allocations.api_session = reporting.api_session
+
+
+def _max_rss():
+    """The peak resident set size of this process, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024.0
+
+
+def _run_task(name, cloud, args, results):
+    from hivemind_contrib import cache
+
+    sys.stdout = open(os.devnull, 'w')
+    cache_dir = tempfile.mkdtemp(prefix='hivemind-benchmark-')
+    try:
+        cache.CACHE_DIR = cache_dir
+        counter = fakes.CallCounter(args.latency)
+        _install_fakes(cloud, counter)
+        task = _tasks(cloud, args.concurrency)[name]
+        if args.warm:
+            task()
+            counter.reset()
+        baseline = _max_rss()
+        started = time.time()
+        task()
+        results.put({'task': name,
+                     'wall': time.time() - started,
+                     'peak_rss': _max_rss(),
+                     'rss_growth': _max_rss() - baseline,
+                     'calls': dict(counter.counts)})
+    except Exception:
+        results.put({'task': name, 'error': traceback.format_exc()})
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def run(cloud, names, args):
+    """Run each named task in a forked process, returning its results."""
+    results = []
+    for name in names:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_task,
+                                          args=(name, cloud, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    return results
+
+
+def report(results):
+    summary = PrettyTable(["Task", "Wall (s)", "Peak RSS (MB)",
+                           "RSS growth (MB)", "API calls"])
+    calls = PrettyTable(["Task", "Endpoint", "Calls"])
+    for result in results:
+        if 'error' in result:
+            summary.add_row([result['task'], 'failed', '', '', ''])
+            print >> sys.stderr, result['error']
+            continue
+        summary.add_row([result['task'], '%.2f' % result['wall'],
+                         '%.1f' % result['peak_rss'],
+                         '%.1f' % result['rss_growth'],
+                         sum(result['calls'].values())])
+        for endpoint, count in sorted(result['calls'].items()):
+            calls.add_row([result['task'], endpoint, count])
+    print summary
+    print calls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('tasks', nargs='*',
+                        help='the tasks to run (default: all of them)')
+    parser.add_argument('--tenants', type=int, default=100)
+    parser.add_argument('--servers', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every API call')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warm', action='store_true',
+                        help='run each task once to fill the cache first')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as JSON')
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    cloud = fakes.Cloud(tenants=args.tenants, servers=args.servers,
+                        users=args.users, seed=args.seed)
+    print 'Generated {0} tenants, {1} servers and {2} users in {3:.1f}s' \
+        .format(args.tenants, args.servers, args.users,
+                time.time() - started)
+
+    names = args.tasks or _tasks(cloud, args.concurrency).keys()
+    for name in names:
+        if name not in _tasks(cloud, args.concurrency):
+            parser.error('unknown task {0}'.format(name))
+    results = run(cloud, names, args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'parameters': vars(args), 'results': results}, fp,
+                      indent=2)
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,59 +1,252 @@
+import bisect
 import os
 import sys
 import datetime
 import requests
+import threading
+import time
 from fabric.api import task
 import collections
 import csv
 
+from novaclient import exceptions as nova_exceptions
+
 import hivemind_contrib.keystone as hm_keystone
 import hivemind_contrib.nova as hm_nova
+from hivemind_contrib import cache
+from hivemind_contrib import workers
 
 from hivemind.decorators import verbose
 from hivemind_contrib.reporting import csv_output, pretty_output, \
-    NectarApiSession
-
-def _get_current_allocations():    
-    allocations_api = NectarApiSession()
-    allocations = allocations_api.get_allocations(); 
-    tenant_allocations = {}
-    for alloc in allocations:
-        if alloc['status'] != 'A' and alloc['status'] != 'X':
-            continue
-        uuid = alloc['tenant_uuid']
-        if uuid == None or uuid == '':
-            continue
-        if uuid in tenant_allocations:
-            old_alloc = tenant_allocations[uuid]
-            if alloc['modified_time'] > old_alloc['modified_time']:
-                tenant_allocations[uuid] = alloc
+    api_session
+
+
+ALLOCATION_STORE_TTL = int(os.environ.get('HIVEMIND_ALLOCATION_STORE_TTL',
+                                          86400))
+
+
+class AllocationStore(object):
+    """The allocation records from the allocations API, indexed by
+    tenant, status and modified time.
+
+    The records are kept in the local cache, and refresh() only asks the
+    API for records modified since the newest one already seen.  The
+    whole set is reloaded once the cache is more than ttl seconds old.
+    """
+    APPROVED = ('A', 'X')
+
+    def __init__(self, api=None, ttl=ALLOCATION_STORE_TTL, reload=False):
+        self.api = api or api_session()
+        self.key = 'nectar-allocations-%s' % cache.namespace(
+            "%s %s" % (self.api.auth[0], self.api.api_url))
+        self.records = {}
+        self.by_tenant = collections.defaultdict(dict)
+        self.by_status = collections.defaultdict(set)
+        self.by_modified = []
+        self.current = {}
+        cached = None if reload else cache.load(self.key, ttl)
+        if cached is not None:
+            for alloc in cached:
+                self._add(alloc)
+        self.refresh()
+
+    @property
+    def synced(self):
+        """The modified time of the newest record seen."""
+        return self.by_modified[-1][0] if self.by_modified else None
+
+    def _add(self, alloc):
+        old = self.records.get(alloc['id'])
+        if old is not None:
+            self.by_status[old['status']].discard(old['id'])
+            self.by_modified.remove((old['modified_time'], old['id']))
+            if old['tenant_uuid']:
+                del self.by_tenant[old['tenant_uuid']][old['id']]
+                self._update_current(old['tenant_uuid'])
+        self.records[alloc['id']] = alloc
+        self.by_status[alloc['status']].add(alloc['id'])
+        bisect.insort(self.by_modified, (alloc['modified_time'], alloc['id']))
+        if alloc['tenant_uuid']:
+            self.by_tenant[alloc['tenant_uuid']][alloc['id']] = alloc
+            self._update_current(alloc['tenant_uuid'])
+
+    def _update_current(self, uuid):
+        approved = [alloc for alloc in self.by_tenant[uuid].values()
+                    if alloc['status'] in self.APPROVED]
+        if approved:
+            self.current[uuid] = max(
+                approved, key=lambda alloc: alloc['modified_time'])
         else:
-            tenant_allocations[uuid] = alloc
-    return tenant_allocations
+            self.current.pop(uuid, None)
+
+    def refresh(self):
+        """Fetch the records modified since the last sync, returning the
+        ones that changed.  Records modified at the last synced time are
+        fetched again, as more may have been saved at that time after
+        the last sync; the ones already seen are unchanged.
+        """
+        changed = []
+        for alloc in self.api.iter_allocations(modified_since=self.synced):
+            if self.records.get(alloc['id']) != alloc:
+                self._add(alloc)
+                changed.append(alloc)
+        if changed:
+            cache.save(self.key, self.records.values())
+        return changed
+
+    def current_allocation(self, uuid):
+        """The newest approved allocation for a tenant, or None."""
+        return self.current.get(uuid)
+
+    def current_allocations(self):
+        """The newest approved allocation of every tenant."""
+        return dict(self.current)
+
+    def with_status(self, status):
+        return [self.records[id] for id in self.by_status[status]]
+
+    def modified_since(self, modified_time):
+        """The records modified after modified_time, oldest first."""
+        start = bisect.bisect_left(self.by_modified, (modified_time,))
+        return [self.records[id] for time, id in self.by_modified[start:]
+                if time != modified_time]
+
+
+_allocation_store = None
+_allocation_store_lock = threading.Lock()
+
+
+def allocation_store():
+    """Return the AllocationStore shared by the whole process."""
+    global _allocation_store
+    with _allocation_store_lock:
+        if _allocation_store is None:
+            _allocation_store = AllocationStore()
+        return _allocation_store
+
+
+def _get_current_allocations():
+    return allocation_store().current_allocations()
 
 
 def _get_flavor_map(nova_api):
-    flavors = {}
-    for flavor in nova_api.flavors.list(is_public=True):
-        flavors[flavor.id] = flavor
-    for flavor in nova_api.flavors.list(is_public=False):
-        flavors[flavor.id] = flavor
-    return flavors
+    return hm_nova.FlavorCache(nova_api)
 
 
-def _get_usage(nova_api, flavors, uuid):
+def _fetch_flavors(flavors, flavor_ids):
+    """Fetch the flavors that aren't in the flavor cache (usually deleted
+    ones) in one batch, so _sum_usage can find them.
+    """
+    for flavor_id in flavors.fetch(set(flavor_ids)):
+        print 'Cannot find flavor {0}'.format(flavor_id)
+
+
+def _sum_usage(flavors, instance_flavors):
+    """Sum the instances, vCPUs and RAM of a list of instance flavor ids,
+    whose flavors have already been fetched with _fetch_flavors.
+    Instances whose flavor can't be found are counted, but with no vCPUs
+    or RAM.
+    """
+    vcpus = 0
+    ram = 0
+    for flavor_id in instance_flavors:
+        flavor = flavors.get(flavor_id)
+        if flavor is not None:
+            vcpus += flavor.vcpus
+            ram += flavor.ram
+    return {'instances': len(instance_flavors), 'ram': ram, 'vcpus': vcpus}
+
+
+def _list_instance_flavors(nova_api, uuid):
     instances = nova_api.servers.list(search_opts={'project_id': uuid,
                                                    'tenant_id': uuid,
                                                    'all_tenants': 1})
-    if len(instances) == 0:
-        return {'instances': 0, 'ram': 0, 'vcpus': 0}
-    instance_flavors = map(lambda x: flavors[x.flavor['id']], instances);
-    vcpus = 0;
-    ram = 0;
-    for flavor in instance_flavors:
-        vcpus += flavor.vcpus
-        ram += flavor.ram
-    return {'instances': len(instances), 'ram': ram, 'vcpus': vcpus}
+    return [x.flavor['id'] for x in instances]
+
+
+def _get_usage(nova_api, flavors, uuid):
+    instance_flavors = _list_instance_flavors(nova_api, uuid)
+    _fetch_flavors(flavors, instance_flavors)
+    return _sum_usage(flavors, instance_flavors)
+
+
+def _get_all_usage(nova_api, flavors, page_size=1000):
+    """Get the usage of every tenant from one paginated sweep of all
+    servers.  Tenants without instances have zero usage.
+    """
+    instance_flavors = collections.defaultdict(list)
+    for server in hm_nova.list_servers(nova_api,
+                                       search_opts={'all_tenants': 1},
+                                       page_size=page_size):
+        instance_flavors[server.tenant_id].append(server.flavor['id'])
+    _fetch_flavors(flavors, (flavor_id
+                             for tenant_flavors in instance_flavors.values()
+                             for flavor_id in tenant_flavors))
+    usage = collections.defaultdict(
+        lambda: {'instances': 0, 'ram': 0, 'vcpus': 0})
+    for tenant_id, tenant_flavors in instance_flavors.items():
+        usage[tenant_id] = _sum_usage(flavors, tenant_flavors)
+    return usage
+
+
+QUOTA_RESOURCES = [
+    # (nova quota, usage key, label)
+    ('instances', 'instances', 'Instance quota'),
+    ('cores', 'vcpus', 'VCPU quota'),
+    ('ram', 'ram', 'RAM quota'),
+]
+
+Comparison = collections.namedtuple(
+    'Comparison', ['tenant_id', 'allocation', 'allocated', 'quotas', 'usage',
+                   'quota_mismatches', 'over_quota'])
+
+Reversion = collections.namedtuple(
+    'Reversion', ['comparison', 'usage', 'deltas', 'update'])
+
+
+def allocated_quotas(alloc):
+    """The nova quotas an allocation grants.  Allocations record RAM in
+    GB, nova in MB.
+    """
+    return {'instances': alloc['instance_quota'],
+            'cores': alloc['core_quota'],
+            'ram': alloc['ram_quota'] * 1024}
+
+
+def _quota_mismatches(allocated, quotas):
+    if quotas is None:
+        return []
+    return [quota for quota, key, label in QUOTA_RESOURCES
+            if getattr(quotas, quota) != allocated[quota]]
+
+
+def _over_quota(allocated, usage):
+    if usage is None:
+        return []
+    return [quota for quota, key, label in QUOTA_RESOURCES
+            if usage[key] > allocated[quota]]
+
+
+def compare_allocations(allocations, quotas=None, usage=None):
+    """Compare each tenant's allocation with its nova quotas and usage.
+
+    allocations, quotas and usage are dicts keyed by tenant id; quotas
+    and usage are optional, as are their entries.  Returns a Comparison
+    per allocation, where quota_mismatches lists the quotas nova has set
+    differently from the allocation and over_quota the quotas that the
+    tenant's usage exceeds.
+    """
+    comparisons = []
+    for uuid, alloc in allocations.iteritems():
+        allocated = allocated_quotas(alloc)
+        tenant_quotas = quotas.get(uuid) if quotas is not None else None
+        tenant_usage = usage.get(uuid) if usage is not None else None
+        comparisons.append(Comparison(
+            uuid, alloc, allocated, tenant_quotas, tenant_usage,
+            _quota_mismatches(allocated, tenant_quotas),
+            _over_quota(allocated, tenant_usage)))
+    return comparisons
+
 
 @task
 @verbose
@@ -65,232 +258,607 @@ def crosscheck_usage(filename=None):
     allocations = _get_current_allocations()
     nova_api = hm_nova.client()
     flavors = _get_flavor_map(nova_api)
+    all_usage = _get_all_usage(nova_api, flavors)
     missing = []
-    mismatches = []
-    for uuid in allocations.keys():
-        alloc = allocations[uuid]
-        usage = _get_usage(nova_api, flavors, uuid)
-        if (usage['instances'] > alloc['instance_quota']
-            or usage['vcpus'] > alloc['core_quota'] 
-            or usage['ram'] > alloc['ram_quota'] * 1024):
-            alloc['nova_usage'] = usage
-            mismatches.append(alloc)
+    mismatches = [c for c in compare_allocations(allocations,
+                                                 usage=all_usage)
+                  if c.over_quota]
 
     print '{0} allocations, {1} missing tenants, {2} usage mismatches'.format(
         len(allocations), len(missing), len(mismatches))
-    
+
     fields_to_report = [
-        ("Tenant ID", lambda x: x['tenant_uuid']),
-        ("Tenant Name", lambda x: x['tenant_name']),
-        ("Modified time", lambda x: x['modified_time']),
-        ("Instances", lambda x: x['instance_quota']),
-        ("Nova instances", lambda x: x['nova_usage']['instances']),
-        ("vCPU quota", lambda x: x['core_quota']),
-        ("Nova vCPU usage", lambda x: x['nova_usage']['vcpus']),
-        ("RAM quota", lambda x: x['ram_quota'] * 1024),
-        ("Nova RAM usage", lambda x: x['nova_usage']['ram'])
+        ("Tenant ID", lambda x: x.allocation['tenant_uuid']),
+        ("Tenant Name", lambda x: x.allocation['tenant_name']),
+        ("Modified time", lambda x: x.allocation['modified_time']),
+        ("Instances", lambda x: x.allocated['instances']),
+        ("Nova instances", lambda x: x.usage['instances']),
+        ("vCPU quota", lambda x: x.allocated['cores']),
+        ("Nova vCPU usage", lambda x: x.usage['vcpus']),
+        ("RAM quota", lambda x: x.allocated['ram']),
+        ("Nova RAM usage", lambda x: x.usage['ram'])
         ]
     csv_output(map(lambda x: x[0], fields_to_report),
-               map(lambda alloc: map(
-                   lambda y: y[1](alloc),
+               map(lambda comparison: map(
+                   lambda y: y[1](comparison),
                    fields_to_report),
                    mismatches),
                filename=filename)
 
 
+def _get_quota(nova_api, uuid, retries=3):
+    """Fetch the nova quotas of a tenant, or None if nova doesn't know
+    about it.  Transient failures are retried with jitter.
+    """
+    def get():
+        try:
+            return nova_api.quotas.get(uuid)
+        except nova_exceptions.NotFound:
+            return None
+    return workers.retry(get, attempts=retries, jitter=1)
+
+
+def _get_quotas(nova_api, uuids, concurrency=8, retries=3):
+    """Fetch the nova quotas of each tenant, concurrency at a time.
+    Transient failures are retried with jitter; a tenant nova doesn't
+    know about is not.  Returns a dict of tenant id to quotas, the ids of
+    the tenants that weren't found, and a dict of tenant id to the last
+    error for the tenants that still failed.
+    """
+    def fetch(uuid):
+        try:
+            return uuid, _get_quota(nova_api, uuid, retries), None
+        except Exception as e:
+            return uuid, None, e
+
+    quotas = {}
+    not_found = []
+    errors = {}
+    for uuid, quota, error in workers.imap(fetch, uuids, concurrency):
+        if error is not None:
+            errors[uuid] = error
+        elif quota is None:
+            not_found.append(uuid)
+        else:
+            quotas[uuid] = quota
+    return quotas, not_found, errors
+
+
 @task
 @verbose
-def crosscheck_quotas(filename=None):
-    """Cross-check allocation and quota information for all tenants
+def crosscheck_quotas(filename=None, concurrency=8, retries=3, timeout=60):
+    """Cross-check allocation and quota information for all tenants.
+    Quotas are fetched concurrency at a time, with each request timing
+    out after timeout seconds and being retried up to retries times.
     """
 
     allocations = _get_current_allocations()
-    nova_api = hm_nova.client()
-    missing = []
-    mismatches = []
-    for uuid in allocations.keys():
-        alloc = allocations[uuid]
-        try:
-            quotas = nova_api.quotas.get(uuid)
-        except:
-            missing.append(alloc)
-            continue
-        if (quotas.instances != alloc['instance_quota'] \
-            or quotas.ram != alloc['ram_quota'] * 1024 \
-            or quotas.cores != alloc['core_quota']):
-            alloc['nova_quotas'] = quotas
-            mismatches.append(alloc)
-    print '{0} allocations, {1} missing tenants, {2} quota mismatches'.format(
-        len(allocations), len(missing), len(mismatches))
-    
+    nova_api = hm_nova.client(timeout=float(timeout))
+    all_quotas, not_found, errors = _get_quotas(
+        nova_api, allocations.keys(), concurrency=concurrency,
+        retries=retries)
+    mismatches = [c for c in compare_allocations(allocations,
+                                                 quotas=all_quotas)
+                  if c.quota_mismatches]
+    print ('{0} allocations, {1} missing tenants, {2} failed lookups, '
+           '{3} quota mismatches').format(
+        len(allocations), len(not_found), len(errors), len(mismatches))
+    for uuid, error in errors.items():
+        print 'Cannot get quotas for {0}: {1}'.format(uuid, error)
+
     fields_to_report = [
-        ("Tenant ID", lambda x: x['tenant_uuid']),
-        ("Tenant Name", lambda x: x['tenant_name']),
-        ("Modified time", lambda x: x['modified_time']),
-        ("Instances", lambda x: x['instance_quota']),
-        ("Nova instances", lambda x: x['nova_quotas'].instances),
-        ("vCPU quota", lambda x: x['core_quota']),
-        ("Nova vCPU quota", lambda x: x['nova_quotas'].cores),
-        ("RAM quota", lambda x: x['ram_quota'] * 1024),
-        ("Nova RAM quota", lambda x: x['nova_quotas'].ram)
+        ("Tenant ID", lambda x: x.allocation['tenant_uuid']),
+        ("Tenant Name", lambda x: x.allocation['tenant_name']),
+        ("Modified time", lambda x: x.allocation['modified_time']),
+        ("Instances", lambda x: x.allocated['instances']),
+        ("Nova instances", lambda x: x.quotas.instances),
+        ("vCPU quota", lambda x: x.allocated['cores']),
+        ("Nova vCPU quota", lambda x: x.quotas.cores),
+        ("RAM quota", lambda x: x.allocated['ram']),
+        ("Nova RAM quota", lambda x: x.quotas.ram)
         ]
     csv_output(map(lambda x: x[0], fields_to_report),
-               map(lambda alloc: map(
-                   lambda y: y[1](alloc),
+               map(lambda comparison: map(
+                   lambda y: y[1](comparison),
                    fields_to_report),
                    mismatches),
                filename=filename)
 
 
+def _read_names(name_or_id, infile):
+    """The tenant names or ids given as a '+' separated list and/or one
+    per line in infile, in order and without duplicates.
+    """
+    names = []
+    if name_or_id:
+        names.extend(name_or_id.split('+'))
+    if infile is not None:
+        with open(infile, 'rb') as fp:
+            names.extend(line.strip() for line in fp)
+    return list(collections.OrderedDict.fromkeys(
+        name for name in names if name and not name.startswith('#')))
+
+
+def _resolve_tenants(keystone_api, names, concurrency=8, retries=3):
+    """Look up each tenant name or id in keystone, in bulk.  Returns an
+    OrderedDict of name to tenant, with None for the names keystone
+    doesn't know about.
+    """
+    return hm_keystone.tenant_resolver(keystone_api).resolve_many(
+        names, concurrency, retries)
+
+
 @task
 @verbose
-def compare_quotas(name_or_id=None):
-    """Compare the allocation and quota information for a tenant
+def compare_quotas(name_or_id=None, infile=None, as_csv=False,
+                   filename=None, concurrency=8, retries=3, timeout=60):
+    """Compare the allocation and quota information for tenants.
+    Tenants can be given as a '+' separated list of names or ids and/or
+    one per line in infile.  The allocations, flavors and clients are
+    fetched once, and the tenants and their quotas are looked up
+    concurrency at a time.  Usage is only looked up for the tenants
+    whose quotas don't match.
     """
-    if name_or_id == None:
+    names = _read_names(name_or_id, infile)
+    if not names:
         print 'A tenant name or id is required'
         return
-        
+
     keystone_api = hm_keystone.client_session(version=3)
-    try:
-        tenant = hm_keystone.get_tenant(keystone_api, name_or_id)
-    except:
-        print 'Tenant {0} not found in keystone'.format(name_or_id)
-        return
-        
-    nova_api = hm_nova.client()
-    quotas = nova_api.quotas.get(tenant.id)
-    print 'nova quotas: instances {0}, cores {1}, ram {2}'.format(
-        quotas.instances, quotas.cores, quotas.ram / 1024)
-    usage = _get_usage(nova_api, _get_flavor_map(nova_api), tenant.id)
-    print 'nova usage: instances {0}, cores {1}, ram {2}'.format(
-        usage['instances'], usage['vcpus'], usage['ram'] / 1024)
-
-    allocations_api = NectarApiSession()
-    allocations = allocations_api.get_allocations(); 
-    tenant_allocations = filter(lambda x: x['tenant_uuid'] == tenant.id and \
-                                (x['status'] == 'A' or x['status'] == 'X'),
-                                allocations)
-    if len(tenant_allocations) == 0:
-        print 'No approved allocation records for tenant {0} / {1}'.format(
-            tenant.id, tenant.name)
-        return
+    nova_api = hm_nova.client(timeout=float(timeout))
+    flavors = _get_flavor_map(nova_api)
+    store = allocation_store()
+
+    tenants = _resolve_tenants(keystone_api, names, concurrency, retries)
+    for name, tenant in tenants.items():
+        if tenant is None:
+            print 'Tenant {0} not found in keystone'.format(name)
+    tenants = collections.OrderedDict(
+        (tenant.id, tenant) for tenant in tenants.values()
+        if tenant is not None)
+
+    allocations = collections.OrderedDict()
+    for uuid, tenant in tenants.items():
+        alloc = store.current_allocation(uuid)
+        if alloc is None:
+            print 'No approved allocation records for tenant {0} / {1}'.format(
+                uuid, tenant.name)
+        else:
+            allocations[uuid] = alloc
+
+    all_quotas, not_found, errors = _get_quotas(
+        nova_api, allocations.keys(), concurrency=concurrency,
+        retries=retries)
+    for uuid in not_found:
+        print 'Tenant {0} not found in nova'.format(uuid)
+    for uuid, error in errors.items():
+        print 'Cannot get quotas for {0}: {1}'.format(uuid, error)
+
+    def list_flavors(uuid):
+        return uuid, workers.retry(
+            lambda: _list_instance_flavors(nova_api, uuid),
+            attempts=retries, jitter=1)
+
+    comparisons = compare_allocations(
+        collections.OrderedDict((uuid, alloc)
+                                for uuid, alloc in allocations.items()
+                                if uuid in all_quotas),
+        quotas=all_quotas)
+    mismatched = collections.OrderedDict(
+        (c.tenant_id, c.allocation) for c in comparisons
+        if c.quota_mismatches)
+
+    all_instance_flavors = dict(workers.imap(
+        list_flavors, mismatched.keys(), concurrency))
+    _fetch_flavors(flavors, (
+        flavor_id for instance_flavors in all_instance_flavors.values()
+        for flavor_id in instance_flavors))
+    all_usage = dict(
+        (uuid, _sum_usage(flavors, instance_flavors))
+        for uuid, instance_flavors in all_instance_flavors.items())
+    mismatches = compare_allocations(mismatched, quotas=all_quotas,
+                                     usage=all_usage)
+    print '{0} tenants, {1} allocations, {2} quota mismatches'.format(
+        len(names), len(allocations), len(mismatches))
+
+    headings = ["Tenant ID", "Tenant Name", "Resource", "Allocated",
+                "Nova quota", "Used"]
+    rows = [[c.tenant_id, tenants[c.tenant_id].name, label,
+             c.allocated[quota], getattr(c.quotas, quota), c.usage[key]]
+            for c in mismatches
+            for quota, key, label in QUOTA_RESOURCES
+            if quota in c.quota_mismatches]
+    if as_csv:
+        csv_output(headings, rows, filename=filename)
+    else:
+        pretty_output(headings, rows, filename=filename)
+
+
+def _read_deltas(infile, id_col, cores_col, instances_col):
+    """Return an OrderedDict of tenant id to [vCPU delta, instance delta]
+    from the rows of infile, skipping the rows that can't be parsed (such
+    as a header).  If a tenant has more than one row the last one wins,
+    so a correction can be appended to the file.
+    """
+    deltas = collections.OrderedDict()
+    with open(infile, 'rb') as csvfile:
+        for row in csv.reader(csvfile, delimiter=','):
+            try:
+                uuid = row[id_col]
+                tenant_deltas = [int(row[cores_col]),
+                                 int(row[instances_col])]
+            except (IndexError, ValueError):
+                continue
+            if uuid in deltas:
+                print 'Tenant {0} is listed again; using the later ' \
+                    'deltas {1}'.format(uuid, tenant_deltas)
+            deltas[uuid] = tenant_deltas
+    return deltas
+
+
+def _reversion(comparison, deltas, usage):
+    """Decide whether a tenant's nova quotas should be reverted to its
+    allocation.  usage is only needed if the quotas don't match.
+    """
+    # If the alloc and current quotas match, don't touch them
+    if not comparison.quota_mismatches:
+        return Reversion(comparison, None, deltas, 'no - quotas match')
+    # If the usage is greater than the allocated quotas, don't touch them
+    if _over_quota(comparison.allocated, usage):
+        return Reversion(comparison, usage, deltas, 'no - over-quota usage')
+    # If the difference between the nova quotas don't match the
+    # expected quotas (i.e. alloc + deltas), don't touch them
+    if deltas is not None:
+        alloc = comparison.allocation
+        expected = allocated_quotas({
+            'core_quota': alloc['core_quota'] + deltas[0],
+            'instance_quota': alloc['instance_quota'] + deltas[1],
+            'ram_quota': alloc['ram_quota'] + deltas[0] * 4})
+        if _quota_mismatches(expected, comparison.quotas):
+            return Reversion(comparison, usage, deltas, 'no - deltas wrong')
+    return Reversion(comparison, usage, deltas, 'yes')
 
-    tenant_allocations.sort(key=lambda alloc: alloc['modified_time'])
-    current_allocation = tenant_allocations[-1]
-    
-    format = '{0} mismatch: allocated {1}, nova {2}, used {3}'
-    if current_allocation['instance_quota'] != quotas.instances:
-        print format.format('Instance quota',
-                            current_allocation['instance_quota'], 
-                            quotas.instances,
-                            usage['instances'])
-    if current_allocation['core_quota'] != quotas.cores:
-        print format.format('VCPU quota',
-                            current_allocation['core_quota'], 
-                            quotas.cores,
-                            usage['vcpus'])
-    if current_allocation['ram_quota'] * 1024 != quotas.ram:
-        print format.format('RAM quota',
-                            current_allocation['ram_quota'] * 1024, 
-                            quotas.ram,
-                            usage['ram'])
 
 @task
 @verbose
 def quota_reversions(infile=None, id_col=1, cores_col=2, 
-                     instances_col=3, outfile=None):
-    tenants = {};
-    if infile != None:
-        with open(infile, 'rb') as csvfile:
-            for row in csv.reader(csvfile, delimiter=','):
-                try:
-                    tenants[row[id_col]] = [int(row[cores_col]), 
-                                            int(row[instances_col])]
-                except:
-                    continue
-    
-    allocations = _get_current_allocations()
-    nova_api = hm_nova.client()
+                     instances_col=3, outfile=None, concurrency=8,
+                     retries=3, timeout=60):
+    """Plan which tenants' nova quotas should be reverted to their
+    allocation.  If infile is given, only the tenants in it are checked,
+    and their nova quotas must differ from the allocation by the vCPU and
+    instance deltas in it, taking a tenant's last row if it has more than
+    one.  The tenants are checked concurrency at a time, and each
+    decision is written to outfile as it is made.  Give the outfile to
+    apply_quota_reversions to make the updates.
+    """
+    store = allocation_store()
+    if infile is None:
+        tenants = ((uuid, None) for uuid in store.current_allocations())
+    else:
+        tenants = _read_deltas(infile, int(id_col), int(cores_col),
+                               int(instances_col)).items()
+    nova_api = hm_nova.client(timeout=float(timeout))
     flavors = _get_flavor_map(nova_api)
-    updates = []
-    for uuid in allocations.keys():
-        alloc = allocations[uuid]
-        if len(tenants) > 0:
-            # Figure out what the quota should have been prior to
-            # the adjustment
-            if uuid in tenants:
-                deltas = tenants[uuid]
-                expected = {
-                    'core_quota': alloc['core_quota'] + deltas[0],
-                    'instance_quota': alloc['instance_quota'] + deltas[1],
-                    'ram_quota': (alloc['ram_quota'] + deltas[0] * 4) * 1024
-                }
-            else:
-                # No data for this tenant
-                continue
-        else:
-            expected = None
+
+    def fetch(tenant):
+        uuid, deltas = tenant
+        alloc = store.current_allocation(uuid)
+        if alloc is None:
+            return None
         try:
-            quotas = nova_api.quotas.get(uuid)
-        except:
-            continue
-
-        alloc['expected'] = expected
-        alloc['nova_quotas'] = quotas
-        alloc['deltas'] = deltas
-        updates.append(alloc)
-
-        # If the alloc and current quotas match, don't touch them
-        if (quotas.instances == alloc['instance_quota'] \
-            and quotas.ram == alloc['ram_quota'] * 1024 \
-            and quotas.cores == alloc['core_quota']):
-            alloc['update'] = 'no - quotas match'
-            continue
-        usage = _get_usage(nova_api, flavors, uuid)
-        alloc['nova_usage'] = usage
-        # If the usage is greater than the allocated quotas, don't touch them
-        if (usage['instances'] > alloc['instance_quota']
-            or usage['vcpus'] > alloc['core_quota']
-            or usage['ram'] > alloc['ram_quota'] * 1024):
-            alloc['update'] = 'no - over-quota usage'
-            continue
-        # If the difference between the nova quotas don't match the 
-        # expected quotas (i.e. alloc + deltas), don't touch them
-        if (expected != None
-            and (expected['instance_quota'] != quotas.instances
-                 or expected['ram_quota'] != quotas.ram
-                 or expected['core_quota'] != quotas.cores)):
-            alloc['update'] = 'no - deltas wrong'
-            continue
-        alloc['update'] = 'yes'
+            quotas = _get_quota(nova_api, uuid, retries)
+            if quotas is None:
+                return None
+            comparison = compare_allocations({uuid: alloc},
+                                             quotas={uuid: quotas})[0]
+            instance_flavors = None
+            if comparison.quota_mismatches:
+                instance_flavors = workers.retry(
+                    lambda: _list_instance_flavors(nova_api, uuid),
+                    attempts=retries, jitter=1)
+        except Exception as e:
+            print 'Cannot get quotas for {0}: {1}'.format(uuid, e)
+            return None
+        return comparison, deltas, instance_flavors
+
+    def decisions():
+        for result in workers.imap(fetch, tenants, concurrency):
+            if result is None:
+                continue
+            comparison, deltas, instance_flavors = result
+            usage = None
+            if instance_flavors is not None:
+                _fetch_flavors(flavors, instance_flavors)
+                usage = _sum_usage(flavors, instance_flavors)
+            yield _reversion(comparison, deltas, usage)
 
     fields_to_report = [
-        ("Tenant ID", lambda x: x['tenant_uuid']),
-        ("Tenant Name", lambda x: x['tenant_name']),
-        ("Instances", lambda x: x['instance_quota']),
-        ("vCPU quota", lambda x: x['core_quota']),
-        ("Memory", lambda x: x['ram_quota'] * 1024),
-        ("Nova Instance quota", lambda x: x['nova_quotas'].instances),
-        ("Nova vCPU quota", lambda x: x['nova_quotas'].cores),
-        ("Nova Memory quota", lambda x: x['nova_quotas'].ram),
-        ("Nova Instance usage", 
-         lambda x: x['nova_usage']['instances'] if 'nova_usage' in x else ''),
-        ("Nova vCPU usage", 
-         lambda x: x['nova_usage']['vcpus'] if 'nova_usage' in x else ''),
-        ("Nova Memory usage", 
-         lambda x: x['nova_usage']['ram'] if 'nova_usage' in x else ''),
-        ("Instance delta", lambda x: x['deltas'][1] if 'deltas' in x else ''), 
-        ("vCPU delta", lambda x: x['deltas'][0] if 'deltas' in x else ''), 
-        ("Update", lambda x: x['update'])
+        ("Tenant ID", lambda x: x.comparison.allocation['tenant_uuid']),
+        ("Tenant Name", lambda x: x.comparison.allocation['tenant_name']),
+        ("Instances", lambda x: x.comparison.allocated['instances']),
+        ("vCPU quota", lambda x: x.comparison.allocated['cores']),
+        ("Memory", lambda x: x.comparison.allocated['ram']),
+        ("Nova Instance quota", lambda x: x.comparison.quotas.instances),
+        ("Nova vCPU quota", lambda x: x.comparison.quotas.cores),
+        ("Nova Memory quota", lambda x: x.comparison.quotas.ram),
+        ("Nova Instance usage",
+         lambda x: x.usage['instances'] if x.usage else ''),
+        ("Nova vCPU usage",
+         lambda x: x.usage['vcpus'] if x.usage else ''),
+        ("Nova Memory usage",
+         lambda x: x.usage['ram'] if x.usage else ''),
+        ("Instance delta", lambda x: x.deltas[1] if x.deltas else ''),
+        ("vCPU delta", lambda x: x.deltas[0] if x.deltas else ''),
+        ("Update", lambda x: x.update)
         ]
     csv_output(map(lambda x: x[0], fields_to_report),
-               map(lambda alloc: map(
-                   lambda y: y[1](alloc),
+               map(lambda update: map(
+                   lambda y: y[1](update),
                    fields_to_report),
-                   updates),
+                   decisions()),
                filename=outfile)
-    
 
-        
-        
+
+def _read_journal(journal):
+    """The tenants in a quota reversion journal that don't need to be
+    looked at again, i.e. those that didn't fail.
+    """
+    done = set()
+    try:
+        with open(journal, 'rb') as fp:
+            for row in csv.reader(fp):
+                if len(row) >= 2 and row[1] != 'failed':
+                    done.add(row[0])
+    except IOError:
+        pass
+    return done
+
+
+def _apply_reversion(nova_api, row, retries=3):
+    """Set a tenant's nova quotas to its allocation, as planned in a
+    quota_reversions row, unless they have changed since the plan was
+    made.  Returns the tenant id, the outcome and any error.
+    """
+    uuid = row['Tenant ID']
+    target = {'instances': int(row['Instances']),
+              'cores': int(row['vCPU quota']),
+              'ram': int(row['Memory'])}
+    planned = {'instances': int(row['Nova Instance quota']),
+               'cores': int(row['Nova vCPU quota']),
+               'ram': int(row['Nova Memory quota'])}
+
+    def update():
+        quotas = nova_api.quotas.get(uuid)
+        # A retried update may already have gone through.
+        if not _quota_mismatches(target, quotas):
+            return 'updated'
+        if _quota_mismatches(planned, quotas):
+            return 'skipped - quotas changed'
+        nova_api.quotas.update(uuid, **target)
+        return 'updated'
+
+    try:
+        return uuid, workers.retry(update, attempts=retries, jitter=1), ''
+    except Exception as e:
+        return uuid, 'failed', e
+
+
+@task
+@verbose
+def apply_quota_reversions(plan, journal=None, concurrency=4, retries=3,
+                           timeout=60):
+    """Revert the nova quotas of the tenants marked for update in a plan
+    written by quota_reversions, concurrency at a time.  Tenants whose
+    quotas have changed since the plan was made are skipped.  The outcome
+    for each tenant is appended to journal (the plan file name plus
+    '.journal' by default) as it completes; running the task again skips
+    every tenant in the journal except those that failed.
+    """
+    if journal is None:
+        journal = plan + '.journal'
+    done = _read_journal(journal)
+    nova_api = hm_nova.client(timeout=float(timeout))
+
+    def pending():
+        with open(plan, 'rb') as fp:
+            for row in csv.DictReader(fp):
+                if row['Update'] == 'yes' and row['Tenant ID'] not in done:
+                    yield row
+
+    outcomes = collections.Counter()
+    with open(journal, 'ab') as fp:
+        writer = csv.writer(fp)
+        for uuid, outcome, error in workers.imap(
+                lambda row: _apply_reversion(nova_api, row, retries),
+                pending(), concurrency):
+            writer.writerow([uuid, outcome, error])
+            fp.flush()
+            outcomes[outcome] += 1
+            if error:
+                print 'Cannot update quotas for {0}: {1}'.format(uuid, error)
+    print '{0} tenants already done'.format(len(done))
+    for outcome, count in sorted(outcomes.items()):
+        print '{0} tenants {1}'.format(count, outcome)
+
+
+class Reconciler(object):
+    """Keeps the allocations, nova quotas and nova usage of every tenant
+    in memory and re-evaluates a tenant only when one of them changes.
+
+    Servers are tracked with changes-since sweeps, which also return the
+    servers deleted since the last sweep, and allocations with the
+    incremental refresh of the allocation store.  Quotas can't be polled
+    for changes, so they are only fetched for tenants whose allocation
+    changed, plus all of them every quota_interval seconds.
+    """
+    def __init__(self, nova_api, store, flavors, quota_interval=3600,
+                 concurrency=8, retries=3, page_size=1000):
+        self.nova_api = nova_api
+        self.store = store
+        self.flavors = flavors
+        self.quota_interval = quota_interval
+        self.concurrency = concurrency
+        self.retries = retries
+        self.page_size = page_size
+        self.servers = {}
+        self.tenant_servers = collections.defaultdict(dict)
+        self.quotas = {}
+        self.quotas_synced = None
+        self.servers_synced = None
+        self.problems = {}
+
+    def sync_servers(self):
+        """Apply the server changes since the last sweep, returning the
+        tenants whose usage changed.
+        """
+        started = datetime.datetime.utcnow().isoformat()
+        search_opts = {'all_tenants': 1}
+        if self.servers_synced is not None:
+            search_opts['changes-since'] = self.servers_synced
+        changed = set()
+        flavor_ids = set()
+        for server in hm_nova.list_servers(self.nova_api,
+                                           search_opts=search_opts,
+                                           page_size=self.page_size):
+            old_tenant = self.servers.pop(server.id, None)
+            if old_tenant is not None:
+                del self.tenant_servers[old_tenant][server.id]
+                changed.add(old_tenant)
+            if server.status != 'DELETED':
+                self.servers[server.id] = server.tenant_id
+                self.tenant_servers[server.tenant_id][server.id] = \
+                    server.flavor['id']
+                flavor_ids.add(server.flavor['id'])
+                changed.add(server.tenant_id)
+        _fetch_flavors(self.flavors, flavor_ids)
+        # Changes made during the sweep may be seen again next time,
+        # which is harmless as they're merged by server id.
+        self.servers_synced = started
+        return changed
+
+    def sync_quotas(self, uuids):
+        """Fetch the quotas of uuids, returning the tenants whose quotas
+        changed.
+        """
+        quotas, not_found, errors = _get_quotas(
+            self.nova_api, uuids, concurrency=self.concurrency,
+            retries=self.retries)
+        for uuid, error in errors.items():
+            print 'Cannot get quotas for {0}: {1}'.format(uuid, error)
+        changed = set()
+        for uuid in uuids:
+            if uuid in errors:
+                continue
+            new = quotas.get(uuid)
+            old = self.quotas.get(uuid)
+            if new is None:
+                if self.quotas.pop(uuid, None) is not None:
+                    changed.add(uuid)
+            elif old is None or _quota_mismatches(
+                    dict((quota, getattr(old, quota))
+                         for quota, key, label in QUOTA_RESOURCES), new):
+                self.quotas[uuid] = new
+                changed.add(uuid)
+        return changed
+
+    def usage(self, uuid):
+        return _sum_usage(self.flavors,
+                          self.tenant_servers.get(uuid, {}).values())
+
+    def evaluate(self, uuids):
+        """Compare the allocation, quotas and usage of uuids, returning a
+        (status, tenant id, comparison) event for each tenant that started
+        or stopped mismatching, or whose mismatches changed.  The
+        comparison is None once a tenant has no approved allocation or
+        quotas.
+        """
+        events = []
+        for uuid in sorted(uuids):
+            alloc = self.store.current_allocation(uuid)
+            if alloc is None or uuid not in self.quotas:
+                comparison = None
+                problems = None
+            else:
+                comparison = compare_allocations(
+                    {uuid: alloc}, quotas=self.quotas,
+                    usage={uuid: self.usage(uuid)})[0]
+                problems = (tuple(comparison.quota_mismatches),
+                            tuple(comparison.over_quota))
+                if problems == ((), ()):
+                    problems = None
+            old = self.problems.get(uuid)
+            if problems == old:
+                continue
+            if problems is None:
+                del self.problems[uuid]
+                events.append(('resolved', uuid, comparison))
+            else:
+                self.problems[uuid] = problems
+                events.append(('mismatch', uuid, comparison))
+        return events
+
+    def poll(self):
+        """Bring everything up to date, returning the new events."""
+        changed = self.sync_servers()
+        alloc_changed = set(alloc['tenant_uuid']
+                            for alloc in self.store.refresh()
+                            if alloc['tenant_uuid'])
+        changed |= alloc_changed
+        now = time.time()
+        if self.quotas_synced is None or \
+                now - self.quotas_synced >= self.quota_interval:
+            changed |= self.sync_quotas(
+                self.store.current_allocations().keys())
+            self.quotas_synced = now
+        elif alloc_changed:
+            changed |= self.sync_quotas(list(alloc_changed))
+        return self.evaluate(changed)
+
+
+def _format_event(status, uuid, comparison):
+    if comparison is None:
+        return '{0} {1} {2}: no approved allocation or quotas'.format(
+            datetime.datetime.utcnow().isoformat(), status, uuid)
+    details = []
+    for quota, key, label in QUOTA_RESOURCES:
+        if quota in comparison.quota_mismatches:
+            details.append('{0} allocated {1}, nova {2}'.format(
+                label, comparison.allocated[quota],
+                getattr(comparison.quotas, quota)))
+        if quota in comparison.over_quota:
+            details.append('{0} allocated {1}, used {2}'.format(
+                label, comparison.allocated[quota], comparison.usage[key]))
+    return '{0} {1} {2} ({3}){4}'.format(
+        datetime.datetime.utcnow().isoformat(), status, uuid,
+        comparison.allocation['tenant_name'],
+        ': ' + '; '.join(details) if details else '')
+
+
+@task
+@verbose
+def reconcile(interval=60, quota_interval=3600, concurrency=8, retries=3,
+              timeout=60, page_size=1000):
+    """Watch the allocations, nova quotas and nova usage, printing quota
+    and usage mismatches as they appear and are resolved.  Servers and
+    allocations are polled for changes every interval seconds, and all
+    the quotas are fetched again every quota_interval seconds.
+    """
+    nova_api = hm_nova.client(timeout=float(timeout))
+    reconciler = Reconciler(nova_api, allocation_store(),
+                            _get_flavor_map(nova_api),
+                            quota_interval=float(quota_interval),
+                            concurrency=concurrency, retries=retries,
+                            page_size=int(page_size))
+    while True:
+        try:
+            events = reconciler.poll()
+        except Exception as e:
+            print 'Poll failed, will retry: {0}'.format(e)
+            events = []
+        for status, uuid, comparison in events:
+            print _format_event(status, uuid, comparison)
+        sys.stdout.flush()
+        # The shared nova client keeps the timing of every request
+        nova_api.client.reset_timings()
+        time.sleep(float(interval))
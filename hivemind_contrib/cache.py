@@ -0,0 +1,57 @@
+"""A small on-disk cache for API listings that are expensive to download
+and are shared between tasks.
+
+Entries are gzipped JSON files in HIVEMIND_CACHE_DIR (by default
+~/.cache/hivemind_contrib), readable only by the current user.
+"""
+import errno
+import gzip
+import hashlib
+import json
+import os
+import time
+
+
+CACHE_DIR = os.environ.get('HIVEMIND_CACHE_DIR',
+                           os.path.expanduser('~/.cache/hivemind_contrib'))
+
+
+def namespace(url):
+    """A short key for the cloud at url, to keep the entries of different
+    clouds apart.
+    """
+    return hashlib.md5(url or '').hexdigest()[:8]
+
+
+def _path(name):
+    return os.path.join(CACHE_DIR, '%s.json.gz' % name)
+
+
+def load(name, ttl=None):
+    """Return the data cached under name, or None if there is none or it
+    is more than ttl seconds old.
+    """
+    try:
+        with gzip.open(_path(name), 'rb') as fp:
+            entry = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if ttl is not None and time.time() - entry['time'] > float(ttl):
+        return None
+    return entry['data']
+
+
+def save(name, data):
+    """Cache data under name, replacing any existing entry."""
+    try:
+        os.makedirs(CACHE_DIR, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = _path(name)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as fp:
+            json.dump({'time': time.time(), 'data': data}, fp)
+    os.rename(tmp_path, path)
@@ -6,6 +6,7 @@ from glanceclient import client as glance_client
 from glanceclient import exc
 
 import keystone  # hivemind_contrib keystone
+from hivemind_contrib import instrumentation
 from hivemind.decorators import verbose, configurable
 
 from functools import partial
@@ -18,18 +19,19 @@ def get_glance_client(kc, api_version=1, endpoint=None):
     else:
         image_endpoint = endpoint
     gc = glance_client.Client(api_version, image_endpoint, token=kc.auth_token)
-    return gc
+    return instrumentation.wrap(gc, 'glance')
 
 
 @configurable('archivetenant')
 @verbose
 def changetenant(image, tenant=None):
-    """move image to new_tenant"""
+    """move image to new_tenant, given by name or id"""
     msg = " ".join(("No archive tenant set.", "Please set tenant in",
                     "[cfg:hivemind_contrib.glance.archivetenant]"))
     if tenant is None:
         error(msg)
-    image.update(owner=tenant)
+    tenant = keystone.get_tenant(keystone.client(), tenant)
+    image.update(owner=tenant.id)
 
 
 def match(name, build, image):
@@ -0,0 +1,237 @@
+"""Optional instrumentation of the OpenStack and allocations API clients.
+
+Set HIVEMIND_INSTRUMENT=1 to print a summary of the API calls made by a
+task to stderr when it exits, or set it to a file name to write the
+summary there as JSON instead.  The clients returned by the client
+factories are then wrapped in proxies that record, for each endpoint
+and method, the number of calls, a histogram of their latency and the
+number of bytes received (from the Content-Length of the responses).
+Without the setting the clients are returned untouched.
+"""
+import atexit
+import bisect
+import collections
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import types
+import urlparse
+
+import requests
+from prettytable import PrettyTable
+
+
+SETTING = os.environ.get('HIVEMIND_INSTRUMENT', '')
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class CallStats(object):
+    """The calls made to one method of an endpoint."""
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        return {'count': self.count, 'seconds': self.seconds,
+                'max_seconds': self.max_seconds, 'bytes': self.bytes,
+                'histogram': dict(
+                    (_bucket_label(i), n)
+                    for i, n in enumerate(self.histogram) if n)}
+
+
+def _bucket_label(index):
+    if index < len(BUCKETS):
+        return '<=%gs' % BUCKETS[index]
+    return '>%gs' % BUCKETS[-1]
+
+
+class Recorder(object):
+    """Thread-safe CallStats keyed by (endpoint, method).
+
+    While a wrapped call is running its key is pushed onto a per-thread
+    stack, so the HTTP responses received during the call can be counted
+    against it.  Requests made outside of any wrapped call are counted
+    against the host they were sent to.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.defaultdict(CallStats)
+        self.local = threading.local()
+
+    def record(self, key, seconds):
+        with self.lock:
+            self.calls[key].add(seconds)
+
+    def received(self, key, size):
+        with self.lock:
+            self.calls[key].bytes += size
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    def call(self, key, func, *args, **kwargs):
+        """Call func, recording the call under key.  If it returns a
+        generator, the time spent iterating over it is part of the call.
+        """
+        stack = self.stack()
+        stack.append(key)
+        started = time.time()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            stack.pop()
+            seconds = time.time() - started
+            if not isinstance(result, types.GeneratorType):
+                self.record(key, seconds)
+        if isinstance(result, types.GeneratorType):
+            return self._iterate(key, result, seconds)
+        return result
+
+    def _iterate(self, key, generator, seconds):
+        stack = self.stack()
+        try:
+            while True:
+                stack.append(key)
+                started = time.time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.time() - started
+                    stack.pop()
+                yield item
+        finally:
+            self.record(key, seconds)
+
+    def to_dict(self):
+        with self.lock:
+            return dict(('%s %s' % key, stats.to_dict())
+                        for key, stats in self.calls.items())
+
+    def summary(self):
+        table = PrettyTable(["Endpoint", "Method", "Calls", "Total (s)",
+                             "Mean (ms)", "Max (ms)", "Bytes", "Latency"])
+        table.align = 'r'
+        table.align["Endpoint"] = table.align["Method"] = 'l'
+        table.align["Latency"] = 'l'
+        with self.lock:
+            calls = sorted(self.calls.items(),
+                           key=lambda (key, stats): -stats.seconds)
+            for (endpoint, method), stats in calls:
+                table.add_row([
+                    endpoint, method, stats.count, '%.2f' % stats.seconds,
+                    '%.1f' % (1000 * stats.seconds / max(stats.count, 1)),
+                    '%.1f' % (1000 * stats.max_seconds), stats.bytes,
+                    ' '.join('%s:%d' % (_bucket_label(i), n)
+                             for i, n in enumerate(stats.histogram) if n)])
+        return table
+
+
+recorder = Recorder()
+
+
+class Proxy(object):
+    """Wraps a client, recording every method called on it or on the
+    objects (such as managers) reached through its attributes.
+    """
+    def __init__(self, target, endpoint):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_endpoint', endpoint)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name.startswith('_') or inspect.isclass(value):
+            return value
+        if inspect.isroutine(value):
+            return _wrap_method(value, (self._endpoint, name))
+        if hasattr(value, '__dict__'):
+            return Proxy(value, '%s %s' % (self._endpoint, name))
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __repr__(self):
+        return '<Proxy for %r>' % (self._target,)
+
+
+def _wrap_method(method, key):
+    def call(*args, **kwargs):
+        return recorder.call(key, method, *args, **kwargs)
+    call.__name__ = method.__name__
+    call.__doc__ = method.__doc__
+    return call
+
+
+_original_send = requests.Session.send
+
+
+def _send(session, request, **kwargs):
+    response = _original_send(session, request, **kwargs)
+    key = recorder.current()
+    if key is None:
+        key = ('http %s' % urlparse.urlparse(request.url).netloc,
+               request.method)
+        recorder.record(key, response.elapsed.total_seconds())
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit():
+        recorder.received(key, int(length))
+    return response
+
+
+def enabled():
+    return SETTING.lower() not in ('', '0', 'false', 'no')
+
+
+def _report():
+    if not recorder.calls:
+        return
+    if SETTING.lower() in ('1', 'true', 'yes'):
+        print >> sys.stderr, recorder.summary()
+    else:
+        with open(SETTING, 'w') as fp:
+            json.dump(recorder.to_dict(), fp, indent=2, sort_keys=True)
+
+
+_install_lock = threading.Lock()
+_installed = []
+
+
+def _install():
+    with _install_lock:
+        if not _installed:
+            requests.Session.send = _send
+            atexit.register(_report)
+            _installed.append(True)
+
+
+def wrap(client, endpoint):
+    """Return client wrapped for instrumentation under the name endpoint
+    if instrumentation is enabled, or else client itself.
+    """
+    if not enabled():
+        return client
+    _install()
+    return Proxy(client, endpoint)
@@ -1,5 +1,9 @@
 import collections
+import csv
+import json
 import os
+import threading
+import time
 
 from fabric.api import task
 from prettytable import PrettyTable
@@ -7,70 +11,354 @@ from keystoneclient.v2_0 import client as keystone_client
 from keystoneclient.v3 import client as keystone_client_v3
 from keystoneclient import session as keystone_session
 from keystoneclient.auth import identity as keystone_identity
-from keystoneclient.exceptions import NotFound
+from keystoneclient.exceptions import NotFound, NoUniqueMatch
 
 from hivemind.decorators import verbose, configurable
 
+from hivemind_contrib import cache
+from hivemind_contrib import instrumentation
+from hivemind_contrib import workers
 
-@configurable('nectar.openstack.client')
-def client(url=None, username=None, password=None, tenant=None, version=2):
+
+DIRECTORY_TTL = int(os.environ.get('HIVEMIND_DIRECTORY_TTL', 3600))
+RESOLVER_TTL = int(os.environ.get('HIVEMIND_RESOLVER_TTL', 300))
+RESOLVER_SIZE = 10000
+RESOLVER_BULK_THRESHOLD = 50
+TENANT_MANAGER_ROLE = 14
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+_key_locks = collections.defaultdict(threading.Lock)
+
+
+def shared(key, factory):
+    """Return the object registered under key, creating it with factory
+    the first time.  The registry is shared by the whole process, so
+    clients and sessions built once are reused by every task and thread.
+    Only lookups of the same key wait while factory runs, so a slow login
+    doesn't hold up the others.
+    """
+    with _registry_lock:
+        if key in _registry:
+            return _registry[key]
+        key_lock = _key_locks[key]
+    with key_lock:
+        with _registry_lock:
+            if key in _registry:
+                return _registry[key]
+        value = factory()
+        with _registry_lock:
+            _registry[key] = value
+        return value
+
+
+def _credentials(url, username, password, tenant):
     url = os.environ.get('OS_AUTH_URL', url)
     username = os.environ.get('OS_USERNAME', username)
     password = os.environ.get('OS_PASSWORD', password)
     tenant = os.environ.get('OS_TENANT_NAME', tenant)
     assert url and username and password and tenant
-    if version == 2:
-        return keystone_client.Client(username=username,
-                                      password=password,
-                                      tenant_name=tenant,
-                                      insecure=True,
-                                      auth_url=url)
-    else:
-        return keystone_client_v3.Client(username=username,
-                                         password=password,
-                                         project_name=tenant,
-                                         user_domain_id='default',
-                                         auth_url=url.replace('2.0', '3'))
+    return url, username, password, tenant
+
+
+def get_session(url=None, username=None, password=None, tenant=None,
+                timeout=None):
+    """Return the keystone session for these credentials.  Sessions for
+    the same credentials share one auth plugin, which keeps the token and
+    only fetches a new one when it is about to expire.
+    """
+    credentials = _credentials(url, username, password, tenant)
+    url, username, password, tenant = credentials
+    auth = shared(('auth',) + credentials,
+                  lambda: keystone_identity.v2.Password(username=username,
+                                                        password=password,
+                                                        tenant_name=tenant,
+                                                        auth_url=url))
+    return shared(('session', timeout) + credentials,
+                  lambda: keystone_session.Session(auth=auth,
+                                                   timeout=timeout))
+
+
+def auth_url(client):
+    """The keystone URL a client authenticates against."""
+    auth = getattr(getattr(client, 'session', None), 'auth', None)
+    return getattr(auth, 'auth_url', None) or \
+        getattr(client, 'auth_url', None)
+
+
+@configurable('nectar.openstack.client')
+def client(url=None, username=None, password=None, tenant=None, version=2):
+    credentials = _credentials(url, username, password, tenant)
+    url, username, password, tenant = credentials
+
+    def build():
+        if version == 2:
+            keystone = keystone_client.Client(username=username,
+                                              password=password,
+                                              tenant_name=tenant,
+                                              insecure=True,
+                                              auth_url=url)
+        else:
+            keystone = keystone_client_v3.Client(
+                username=username, password=password, project_name=tenant,
+                user_domain_id='default', auth_url=url.replace('2.0', '3'))
+        return instrumentation.wrap(keystone, 'keystone')
+    return shared(('keystone', version) + credentials, build)
 
 
 def client_session(url=None, username=None,
                    password=None, tenant=None, version=2):
-    url = os.environ.get('OS_AUTH_URL', url)
-    username = os.environ.get('OS_USERNAME', username)
-    password = os.environ.get('OS_PASSWORD', password)
-    tenant = os.environ.get('OS_TENANT_NAME', tenant)
-    assert url and username and password and tenant
-    auth = keystone_identity.v2.Password(username=username,
-                                         password=password,
-                                         tenant_name=tenant,
-                                         auth_url=url)
-    session = keystone_session.Session(auth=auth)
-    if version == 2:
-        return keystone_client.Client(session=session)
-    else:
-        return keystone_client_v3.Client(session=session)
+    session = get_session(url, username, password, tenant)
 
+    def build():
+        if version == 2:
+            keystone = keystone_client.Client(session=session)
+        else:
+            keystone = keystone_client_v3.Client(session=session)
+        return instrumentation.wrap(keystone, 'keystone')
+    return shared(('keystone-session', version, session), build)
 
-def get_tenant(keystone, name_or_id):
-    if keystone.version == 'v3':
+
+class Directory(object):
+    """A snapshot of the users, projects and role assignments in keystone.
+
+    Listings are kept in the local cache and shared between tasks until
+    they are more than ttl seconds old, or refresh is set.
+    """
+    def __init__(self, keystone, ttl=DIRECTORY_TTL, refresh=False):
+        self.keystone = keystone
+        self.ttl = ttl
+        self.refresh = refresh
+        self.namespace = cache.namespace(auth_url(keystone))
+        self.listings = {}
+        self.indexes = {}
+
+    def _list(self, name, manager, **kwargs):
+        if name not in self.listings:
+            key = 'keystone-%s-%s' % (self.namespace, name)
+            data = None if self.refresh else cache.load(key, self.ttl)
+            if data is None:
+                data = [x.to_dict() for x in manager.list(**kwargs)]
+                cache.save(key, data)
+            self.listings[name] = [
+                manager.resource_class(manager, info, loaded=True)
+                for info in data]
+        return self.listings[name]
+
+    def users(self):
+        return self._list('users', self.keystone.users)
+
+    def projects(self):
+        return self._list('projects', self.keystone.projects)
+
+    def roles(self):
+        return self._list('roles', self.keystone.roles)
+
+    def role_assignments(self, role=None):
+        if role is None:
+            return self._list('role_assignments',
+                              self.keystone.role_assignments)
+        return self._list('role_assignments-%s' % role,
+                          self.keystone.role_assignments, role=role)
+
+    def user_emails(self):
+        """Map user ids to email addresses, for users that have one."""
+        if 'user_emails' not in self.indexes:
+            emails = {}
+            for user in self.users():
+                email = user.to_dict().get('email')
+                if email is not None:
+                    emails[user.id] = email
+            self.indexes['user_emails'] = emails
+        return self.indexes['user_emails']
+
+    def project_managers(self):
+        """Map project ids to the ids of their tenant managers."""
+        if 'project_managers' not in self.indexes:
+            managers = collections.defaultdict(list)
+            for user_role in self.role_assignments(role=TENANT_MANAGER_ROLE):
+                if 'project' in user_role.scope:
+                    managers[user_role.scope['project']['id']].append(
+                        user_role.user['id'])
+            self.indexes['project_managers'] = dict(managers)
+        return self.indexes['project_managers']
+
+    def _find(self, name, resources, name_or_id):
+        if name not in self.indexes:
+            ids = {}
+            names = collections.defaultdict(list)
+            for resource in resources():
+                ids[resource.id] = resource
+                names[resource.name].append(resource)
+            self.indexes[name] = (ids, dict(names))
+        ids, names = self.indexes[name]
+        if name_or_id in ids:
+            return [ids[name_or_id]]
+        return names.get(name_or_id, [])
+
+    def find_projects(self, name_or_id):
+        """The project with the id name_or_id, or else the projects with
+        that name.
+        """
+        return self._find('projects_by_name', self.projects, name_or_id)
+
+    def find_users(self, name_or_id):
+        """The user with the id name_or_id, or else the users with that
+        name.
+        """
+        return self._find('users_by_name', self.users, name_or_id)
+
+
+class Resolver(object):
+    """Resolves project or user names and ids with a keystone manager.
+
+    Answers, including names that don't exist, are remembered for ttl
+    seconds in an LRU of at most size entries.  resolve_many() looks up a
+    batch of at least bulk_threshold unknown names with one listing
+    instead of one or two requests per name.
+    """
+    def __init__(self, manager, size=RESOLVER_SIZE, ttl=RESOLVER_TTL,
+                 bulk_threshold=RESOLVER_BULK_THRESHOLD):
+        self.manager = manager
+        self.size = size
+        self.ttl = ttl
+        self.bulk_threshold = bulk_threshold
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def _cached(self, name_or_id):
+        """Return the (resource or None,) cached for name_or_id, or None
+        if there isn't a fresh entry.
+        """
+        with self.lock:
+            entry = self.entries.pop(name_or_id, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            self.entries[name_or_id] = entry
+            return entry[1:]
+
+    def _remember(self, name_or_id, resource):
+        with self.lock:
+            self.entries.pop(name_or_id, None)
+            self.entries[name_or_id] = (time.time(), resource)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def forget(self, resource_id):
+        """Drop the cached answers for a resource after updating it,
+        along with the names that weren't found, in case the update
+        gave it one of them.
+        """
+        with self.lock:
+            for key, entry in self.entries.items():
+                if key == resource_id or entry[1] is None or \
+                        entry[1].id == resource_id:
+                    del self.entries[key]
+
+    def _lookup(self, name_or_id):
         try:
-            tenant = keystone.projects.get(name_or_id)
+            return self.manager.get(name_or_id)
         except NotFound:
-            tenant = keystone.projects.find(name=name_or_id)
-    else:
+            pass
         try:
-            tenant = keystone.tenants.get(name_or_id)
+            return self.manager.find(name=name_or_id)
         except NotFound:
-            tenant = keystone.tenants.find(name=name_or_id)
-    return tenant
+            return None
+
+    def resolve(self, name_or_id):
+        """Return the resource with the id or name name_or_id, raising
+        NotFound if there isn't one.
+        """
+        cached = self._cached(name_or_id)
+        if cached is None:
+            resource = self._lookup(name_or_id)
+            self._remember(name_or_id, resource)
+        else:
+            resource = cached[0]
+        if resource is None:
+            raise NotFound("No match for %s." % name_or_id)
+        return resource
+
+    def resolve_many(self, names, concurrency=8, retries=3):
+        """Resolve each name or id in names, returning an OrderedDict of
+        name to resource, or None for names that don't exist or are
+        ambiguous.
+        """
+        results = collections.OrderedDict((name, None) for name in names)
+        unknown = []
+        for name in results:
+            cached = self._cached(name)
+            if cached is None:
+                unknown.append(name)
+            else:
+                results[name] = cached[0]
+        if len(unknown) >= self.bulk_threshold:
+            resources = workers.retry(self.manager.list, attempts=retries,
+                                      jitter=1)
+            ids = dict((resource.id, resource) for resource in resources)
+            by_name = collections.defaultdict(list)
+            for resource in resources:
+                by_name[resource.name].append(resource)
+            for name in unknown:
+                matches = [ids[name]] if name in ids else \
+                    by_name.get(name, [])
+                if len(matches) < 2:
+                    results[name] = matches[0] if matches else None
+                    self._remember(name, results[name])
+        else:
+            def get(name):
+                try:
+                    return self.resolve(name)
+                except (NotFound, NoUniqueMatch):
+                    return None
+
+            def resolve(name):
+                return name, workers.retry(lambda: get(name),
+                                           attempts=retries, jitter=1)
+            results.update(workers.imap(resolve, unknown, concurrency))
+        return results
+
+
+def _resolver(keystone, kind):
+    return shared(('resolver', kind, keystone),
+                  lambda: Resolver(getattr(keystone, kind)))
+
+
+def tenant_resolver(keystone):
+    """The shared Resolver for keystone's projects (v3) or tenants
+    (v2).
+    """
+    return _resolver(keystone,
+                     'projects' if keystone.version == 'v3' else 'tenants')
+
+
+def user_resolver(keystone):
+    """The shared Resolver for keystone's users."""
+    return _resolver(keystone, 'users')
+
+
+def forget(resource_id):
+    """Drop a project or user from every shared Resolver after updating
+    it, whichever client it was looked up with.
+    """
+    with _registry_lock:
+        resolvers = [resolver for resolver in _registry.values()
+                     if isinstance(resolver, Resolver)]
+    for resolver in resolvers:
+        resolver.forget(resource_id)
+
+
+def get_tenant(keystone, name_or_id):
+    return tenant_resolver(keystone).resolve(name_or_id)
 
 
 def get_user(keystone, name_or_id):
-    try:
-        tenant = keystone.users.get(name_or_id)
-    except NotFound:
-        tenant = keystone.users.find(name=name_or_id)
-    return tenant
+    return user_resolver(keystone).resolve(name_or_id)
 
 
 @task
@@ -137,13 +425,14 @@ def set_project_metadata(project, key, value):
     project = get_tenant(keystone, project)
     kwargs = {key: value}
     keystone.tenants.update(project.id, **kwargs)
+    forget(project.id)
 
 
 def clear_project_metadata(project, key):
     """Set a key on a keystone project to None.
 API doesn't appear to be able to delete the key
     """
-    set_project_metadata(project.id, key, None)
+    set_project_metadata(project, key, None)
 
 
 @task
@@ -155,6 +444,7 @@ def set_user_metadata(user, key, value):
     user = get_user(keystone, user)
     kwargs = {key: value}
     keystone.users.update(user.id, **kwargs)
+    forget(user.id)
 
 
 @task
@@ -166,11 +456,169 @@ API doesn't appear to be able to delete the key
     set_user_metadata(user, key, None)
 
 
+METADATA_FIELDS = ['entity', 'key', 'value', 'type', 'mode']
+
+
+def _read_metadata(infile):
+    """Yield the metadata updates in infile as dicts with the keys in
+    METADATA_FIELDS.  A .jsonl file has one JSON object per line; anything
+    else is read as CSV with a header row.  type defaults to project and
+    mode to set.
+    """
+    with open(infile, 'rb') as fp:
+        if infile.endswith('.jsonl'):
+            rows = (json.loads(line) for line in fp if line.strip())
+        else:
+            rows = csv.DictReader(fp)
+        for row in rows:
+            row = dict((field, row.get(field)) for field in METADATA_FIELDS)
+            row['type'] = row['type'] or 'project'
+            row['mode'] = row['mode'] or 'set'
+            yield row
+
+
+def _write_metadata(filename, rows):
+    """Write metadata update rows in the format _read_metadata reads."""
+    with open(filename, 'wb') as fp:
+        if filename.endswith('.jsonl'):
+            for row in rows:
+                print >> fp, json.dumps(
+                    dict((field, row[field]) for field in METADATA_FIELDS))
+        else:
+            writer = csv.DictWriter(fp, METADATA_FIELDS,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def _apply_metadata(manager, entity_id, rows, retries=3):
+    """Apply the updates in rows, in order, to the project or user
+    entity_id of manager.  In append mode the value is added to the comma
+    separated list already in the key, if it isn't there.  Returns a
+    (status, error) for each row.
+    """
+    results = []
+    current = None
+    for row in rows:
+        key, value = row['key'], row['value']
+        try:
+            if row['mode'] == 'append':
+                if current is None:
+                    current = workers.retry(lambda: manager.get(entity_id),
+                                            attempts=retries, jitter=1)
+                existing = current.to_dict().get(key)
+                values = existing.split(',') if existing else []
+                if value in values:
+                    results.append(('unchanged', ''))
+                    continue
+                value = ','.join(values + [value])
+            elif row['mode'] != 'set':
+                raise ValueError('Unknown mode {0}'.format(row['mode']))
+            current = workers.retry(
+                lambda: manager.update(entity_id, **{key: value}),
+                attempts=retries, jitter=1)
+            results.append(('updated', ''))
+        except Exception as e:
+            results.append(('failed', e))
+    return results
+
+
+@task
+@verbose
+def bulk_metadata(infile, outfile=None, concurrency=8, retries=3,
+                  refresh=False):
+    """Set metadata on many projects and users from a CSV or JSONL file.
+Each row has an entity (a name or id), key and value, and optionally a
+type (project or user, default project) and a mode (set, or append to
+add the value to a comma separated list like allocation_home).  Names
+are resolved against the cached keystone listings, and up to
+concurrency entities are updated at once.  The outcome of each row is
+written to outfile (infile.results.csv by default), and the rows that
+failed to infile.retry in the input's format, ready to be run again.
+    """
+    keystone = client_session(version=3)
+    directory = Directory(keystone, refresh=refresh)
+    if outfile is None:
+        outfile = infile + '.results.csv'
+    base, ext = os.path.splitext(infile)
+    retry_file = base + '.retry' + ext
+
+    # Updates to one entity are applied in order, by the same thread
+    updates = collections.OrderedDict()
+    results = []
+    for number, row in enumerate(_read_metadata(infile)):
+        row['number'] = number
+        if row['type'] == 'user':
+            manager = keystone.users
+            matches = directory.find_users(row['entity'])
+        elif row['type'] == 'project':
+            manager = keystone.projects
+            matches = directory.find_projects(row['entity'])
+        else:
+            results.append((row, 'failed', 'Unknown type'))
+            continue
+        if len(matches) != 1:
+            results.append((row, 'failed', 'Not found' if not matches
+                            else 'Ambiguous name'))
+            continue
+        updates.setdefault((row['type'], matches[0].id),
+                           (manager, matches[0].id, []))[2].append(row)
+
+    def apply((manager, entity_id, rows)):
+        outcomes = _apply_metadata(manager, entity_id, rows, retries)
+        forget(entity_id)
+        return rows, outcomes
+
+    for rows, outcomes in workers.imap(apply, updates.values(),
+                                       concurrency):
+        for row, (status, error) in zip(rows, outcomes):
+            results.append((row, status, error))
+
+    results.sort(key=lambda (row, status, error): row['number'])
+    with open(outfile, 'wb') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(METADATA_FIELDS + ['status', 'error'])
+        for row, status, error in results:
+            writer.writerow([unicode(row[field] or '').encode('utf-8')
+                             for field in METADATA_FIELDS] +
+                            [status, unicode(error).encode('utf-8')])
+    failed = [row for row, status, error in results if status == 'failed']
+    if failed:
+        _write_metadata(retry_file, failed)
+    counts = collections.Counter(status for row, status, error in results)
+    print ', '.join('{0} {1}'.format(count, status)
+                    for status, count in sorted(counts.items()))
+    if failed:
+        print 'Rows to retry written to {0}'.format(retry_file)
+
+
+_role_names = {}
+
+
+def role_name(keystone, role_id):
+    """The name of a role, from a process-wide map of role ids to names
+    that is only listed again when it doesn't know a role.
+    """
+    if role_id not in _role_names:
+        _role_names.update((role.id, role.name)
+                           for role in keystone.roles.list())
+    return _role_names.get(role_id, role_id)
+
+
 def print_members(tenant):
+    keystone = client(version=3)
+    # Effective assignments include the roles users get through groups,
+    # which can give a user the same role more than once.
+    roles = collections.defaultdict(list)
+    for assignment in keystone.role_assignments.list(project=tenant.id,
+                                                     effective=True):
+        if hasattr(assignment, 'user'):
+            name = role_name(keystone, assignment.role['id'])
+            if name not in roles[assignment.user['id']]:
+                roles[assignment.user['id']].append(name)
     users = PrettyTable(["ID", "Email", "Roles"])
     for user in tenant.list_users():
-        roles = ', '.join([r.name for r in user.list_roles(tenant)])
-        users.add_row([user.id, user.email, roles])
+        users.add_row([user.id, user.email, ', '.join(roles[user.id])])
     print "Members of %s:" % tenant.name
     print str(users)
 
@@ -237,40 +685,74 @@ def remove_tenant_manager(tenant, user):
     print_members(tenant)
 
 
-@task
-@verbose
-def user_projects(user):
-    keystone = client(version=3)
-    projects = keystone.projects.list()
-    projects = {project.id: project for project in projects}
-    roles = keystone.roles.list()
-    roles = {role.id: role for role in roles}
-
-    try:
-        user = keystone.users.get(user)
-    except Exception:
-        user = keystone.users.find(name=user)
-
-    if user is None:
-        print("Unknown user")
-        return
-
-    user_project_roles = collections.defaultdict(list)
+def _user_assignments(keystone, user):
+    """Return a map of the ids of the projects user has roles in to the
+    role ids.
+    """
+    project_roles = collections.defaultdict(list)
     for role in keystone.role_assignments.list(user=user):
         try:
             project_id = role.scope['project']['id']
         except KeyError:
             continue
-        role_id = role.role['id']
-        user_project_roles[project_id].append(roles[role_id])
-
-    table = PrettyTable(["ID", "Name", "Roles"])
-    table.sortby = "Name"
-    table.sort_key = lambda x: x[0].lower()
-    table.align = 'l'
-    for project_id, roles in user_project_roles.items():
-        roles = ', '.join(sorted([role.name for role in roles]))
-        project = projects[project_id]
-        table.add_row([project.id, project.name, roles])
-    print "Projects and roles for user %s:" % user.name
-    print str(table)
+        project_roles[project_id].append(role.role['id'])
+    return project_roles
+
+
+def _get_project(keystone, project_id):
+    try:
+        return keystone.projects.get(project_id)
+    except NotFound:
+        return None
+
+
+@task
+@verbose
+def user_projects(user=None, infile=None, concurrency=8, refresh=False):
+    """Print the projects and roles of users, given as a '+' separated
+list of names or ids and/or one per line in infile.  The users are
+looked up concurrency at a time, and only the projects they have roles
+in are fetched, once however many of the users share them.
+    """
+    names = user.split('+') if user else []
+    if infile is not None:
+        with open(infile, 'rb') as fp:
+            names.extend(line.strip() for line in fp)
+    names = [name for name in names if name]
+    if not names:
+        print "A user name or id is required"
+        return
+    keystone = client(version=3)
+    if refresh:
+        _role_names.clear()
+        user_resolver(keystone).clear()
+
+    resolved = user_resolver(keystone).resolve_many(names, concurrency)
+    users = list(workers.imap(
+        lambda (name, user): (name, user, user and _user_assignments(
+            keystone, user)),
+        resolved.items(), concurrency))
+    project_ids = set(project_id
+                      for name, user, project_roles in users if user
+                      for project_id in project_roles)
+    projects = dict(workers.imap(
+        lambda project_id: (project_id, _get_project(keystone, project_id)),
+        project_ids, concurrency))
+
+    for name, user, project_roles in users:
+        if user is None:
+            print "Unknown user %s" % name
+            continue
+        table = PrettyTable(["ID", "Name", "Roles"])
+        table.sortby = "Name"
+        table.sort_key = lambda x: x[0].lower()
+        table.align = 'l'
+        for project_id, role_ids in project_roles.items():
+            roles = ', '.join(sorted([role_name(keystone, role_id)
+                                      for role_id in role_ids]))
+            project = projects[project_id]
+            table.add_row([project_id,
+                           project.name if project is not None else '',
+                           roles])
+        print "Projects and roles for user %s:" % user.name
+        print str(table)
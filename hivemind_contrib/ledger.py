@@ -0,0 +1,204 @@
+"""A local SQLite ledger of daily nova usage.
+
+Usage is collected one day at a time and stored per tenant and per
+instance, so a report only has to ask nova for the days that haven't
+been collected yet and can answer everything else from the ledger.
+"""
+import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy import (Table, Column, Integer, Float, String, Date,
+                        MetaData)
+from sqlalchemy.sql import select, func, and_, bindparam
+
+from hivemind_contrib import workers
+
+
+metadata = MetaData()
+days = Table('day', metadata,
+             Column('day', Date, primary_key=True))
+tenant_usage = Table('tenant_usage', metadata,
+                     Column('day', Date, primary_key=True),
+                     Column('tenant_id', String(64), primary_key=True),
+                     Column('hours', Float),
+                     Column('vcpu_hours', Float),
+                     Column('memory_mb_hours', Float),
+                     Column('local_gb_hours', Float))
+instance_usage = Table('instance_usage', metadata,
+                       Column('day', Date, primary_key=True),
+                       Column('instance_id', String(64), primary_key=True),
+                       Column('tenant_id', String(64), index=True),
+                       Column('name', String(255)),
+                       Column('state', String(32)),
+                       Column('flavor', String(255)),
+                       Column('hours', Float),
+                       Column('vcpus', Integer),
+                       Column('memory_mb', Integer),
+                       Column('local_gb', Integer),
+                       Column('availability_zone', String(255)))
+
+
+def _day_range(start, end):
+    day = start
+    while day < end:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+class UsageLedger(object):
+    """Daily usage stored in the SQLite database at path.  Days are UTC
+    dates, and a period runs from its start day up to but not including
+    its end day.
+    """
+    def __init__(self, path):
+        self.engine = create_engine('sqlite:///%s' % path)
+        metadata.create_all(self.engine)
+
+    def missing_days(self, start, end):
+        """Return the complete days between start and end that are not
+        in the ledger yet.
+        """
+        end = min(end, datetime.datetime.utcnow().date())
+        query = select([days.c.day]).where(
+            and_(days.c.day >= start, days.c.day < end))
+        stored = set(row[0] for row in self.engine.execute(query))
+        return [day for day in _day_range(start, end) if day not in stored]
+
+    def sync(self, nova, start, end, locate=None, concurrency=1,
+             retries=3):
+        """Fetch the usage for the days between start and end that are
+        missing from the ledger, up to concurrency days at a time.
+        locate(tenant_id, server_usage) should return the availability
+        zone of an instance; without it the zones are left empty for
+        locate_instances() to fill in.  Returns the number of days
+        fetched.
+        """
+        missing = self.missing_days(start, end)
+
+        def fetch(day):
+            day_start = datetime.datetime.combine(day, datetime.time())
+            day_end = day_start + datetime.timedelta(days=1)
+            return day, workers.retry(
+                lambda: nova.usage.list(day_start, day_end, detailed=True),
+                attempts=retries)
+
+        for day, usages in workers.imap(fetch, missing, concurrency):
+            self._store_day(day, usages, locate)
+        return len(missing)
+
+    def _store_day(self, day, usages, locate):
+        tenant_rows = []
+        instance_rows = []
+        for u in usages:
+            tenant_rows.append({
+                'day': day,
+                'tenant_id': u.tenant_id,
+                'hours': u.total_hours,
+                'vcpu_hours': u.total_vcpus_usage,
+                'memory_mb_hours': u.total_memory_mb_usage,
+                'local_gb_hours': u.total_local_gb_usage})
+            for iu in u.server_usages:
+                instance_rows.append({
+                    'day': day,
+                    'instance_id': iu['instance_id'],
+                    'tenant_id': u.tenant_id,
+                    'name': iu['name'],
+                    'state': iu['state'],
+                    'flavor': iu['flavor'],
+                    'hours': iu['hours'],
+                    'vcpus': iu['vcpus'],
+                    'memory_mb': iu['memory_mb'],
+                    'local_gb': iu['local_gb'],
+                    'availability_zone': locate and locate(u.tenant_id,
+                                                           iu)})
+        # The day is only marked as collected once all of its usage is
+        # in, so an interrupted sync is picked up again next time.
+        with self.engine.begin() as conn:
+            if tenant_rows:
+                conn.execute(tenant_usage.insert(), tenant_rows)
+            if instance_rows:
+                conn.execute(instance_usage.insert(), instance_rows)
+            conn.execute(days.insert(), {'day': day})
+
+    def locate_instances(self, start, end, locate, concurrency=1):
+        """Fill in the availability zones left empty by sync() for the
+        instances with usage between start and end, concurrency instances
+        at a time.  Zones that locate returns as None stay empty, so they
+        are looked up again next time.  Returns the number of instances
+        located.
+        """
+        query = select([instance_usage.c.tenant_id,
+                        instance_usage.c.instance_id,
+                        instance_usage.c.state]
+                       ).where(and_(instance_usage.c.day >= start,
+                                    instance_usage.c.day < end,
+                                    instance_usage.c.availability_zone
+                                    .is_(None))).distinct()
+        instances = {}
+        for tenant_id, instance_id, state in self.engine.execute(query):
+            # A deleted instance has to be looked up as one
+            if instance_id not in instances or state in ('terminated',
+                                                         'deleted'):
+                instances[instance_id] = (tenant_id, {
+                    'instance_id': instance_id, 'state': state})
+        zones = workers.imap(
+            lambda (tenant_id, iu): (iu['instance_id'],
+                                     locate(tenant_id, iu)),
+            instances.values(), concurrency)
+        update = instance_usage.update().where(and_(
+            instance_usage.c.instance_id == bindparam('id'),
+            instance_usage.c.availability_zone.is_(None))).values(
+                availability_zone=bindparam('az'))
+        rows = [{'id': instance_id, 'az': az} for instance_id, az in zones
+                if az is not None]
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(update, rows)
+        return len(rows)
+
+    def tenant_totals(self, start, end):
+        """Yield (tenant_id, instance count, instance hours, vCPU hours,
+        memory hours, disk hours) for every tenant with usage between
+        start and end.
+        """
+        counts = select([instance_usage.c.tenant_id,
+                         func.count(instance_usage.c.instance_id.distinct())]
+                        ).where(and_(instance_usage.c.day >= start,
+                                     instance_usage.c.day < end)
+                                ).group_by(instance_usage.c.tenant_id)
+        instances = dict(tuple(row) for row in self.engine.execute(counts))
+        totals = select([tenant_usage.c.tenant_id,
+                         func.sum(tenant_usage.c.hours),
+                         func.sum(tenant_usage.c.vcpu_hours),
+                         func.sum(tenant_usage.c.memory_mb_hours),
+                         func.sum(tenant_usage.c.local_gb_hours)]
+                        ).where(and_(tenant_usage.c.day >= start,
+                                     tenant_usage.c.day < end)
+                                ).group_by(tenant_usage.c.tenant_id
+                                           ).order_by(tenant_usage.c.tenant_id)
+        for row in self.engine.execute(totals):
+            yield ((row[0], instances.get(row[0], 0)) + tuple(row[1:]))
+
+    def instance_totals(self, start, end):
+        """Yield a server usage dict for every instance with usage between
+        start and end, with the hours summed over the period and the other
+        details taken from the last day it was seen.
+        """
+        query = select([instance_usage]).where(
+            and_(instance_usage.c.day >= start, instance_usage.c.day < end)
+            ).order_by(instance_usage.c.tenant_id,
+                       instance_usage.c.instance_id,
+                       instance_usage.c.day)
+        current = None
+        for row in self.engine.execute(query):
+            if current is not None and \
+                    current['instance_id'] == row['instance_id']:
+                hours = current['hours'] + row['hours']
+                current = dict(row)
+                current['hours'] = hours
+                continue
+            if current is not None:
+                yield current
+            current = dict(row)
+        if current is not None:
+            yield current
@@ -7,14 +7,20 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from fabric.api import task
 from novaclient import client as nova_client
+from novaclient import exceptions as nova_exceptions
 from prettytable import PrettyTable
 from hivemind.decorators import verbose, only_for, configurable
 from hivemind.operations import run
 from hivemind.util import current_host
 
+from hivemind_contrib import cache
+from hivemind_contrib import instrumentation
+import hivemind_contrib.keystone as hm_keystone
+from hivemind_contrib import workers
 from hivemind_contrib.swift import client as swift_client
 
 DEFAULT_AZ = 'melbourne-qh2'
+FLAVOR_TTL = int(os.environ.get('HIVEMIND_FLAVOR_TTL', 86400))
 DEFAULT_SECURITY_GROUPS = 'default,openstack-node,puppet-client'
 
 FILE_TYPES = {
@@ -24,15 +30,14 @@ FILE_TYPES = {
 
 
 @configurable('nectar.openstack.client')
-def client(url=None, username=None, password=None, tenant=None):
-    url = os.environ.get('OS_AUTH_URL', url)
-    username = os.environ.get('OS_USERNAME', username)
-    password = os.environ.get('OS_PASSWORD', password)
-    tenant = os.environ.get('OS_TENANT_NAME', tenant)
-    assert url and username and password and tenant
-    return nova_client.Client('2',
-                              username=username, api_key=password,
-                              project_id=tenant, auth_url=url)
+def client(url=None, username=None, password=None, tenant=None,
+           timeout=None):
+    session = hm_keystone.get_session(url, username, password, tenant,
+                                      timeout=timeout)
+    return hm_keystone.shared(
+        ('nova', session),
+        lambda: instrumentation.wrap(
+            nova_client.Client('2', session=session), 'nova'))
 
 
 def list_services():
@@ -72,12 +77,109 @@ def enable_host_services(host=None):
             (service["host"], service["binary"]))
 
 
+class FlavorCache(object):
+    """Public and private flavors indexed by id and by name, kept in the
+    local cache for ttl seconds.  Where names clash the public flavor
+    wins, as it did when flavors were looked up with find().
+
+    Flavors that aren't listed any more, like deleted flavors that
+    instances still refer to, are fetched by id with fetch() and then
+    kept in the cache alongside the listed ones, but only by id so they
+    never shadow a live flavor with the same name.
+    """
+    def __init__(self, client, ttl=FLAVOR_TTL, refresh=False):
+        self.client = client
+        self.key = 'nova-flavors-%s' % cache.namespace(
+            hm_keystone.auth_url(client.client))
+        cached = None if refresh else cache.load(self.key, ttl)
+        if not isinstance(cached, dict):
+            cached = {'listed': [
+                flavor.to_dict()
+                for is_public in (True, False)
+                for flavor in client.flavors.list(is_public=is_public)],
+                'fetched': []}
+            cache.save(self.key, cached)
+        self.listed = cached['listed']
+        self.fetched = cached['fetched']
+        self.by_id = {}
+        self.by_name = {}
+        self.not_found = set()
+        for info in self.listed:
+            flavor = self._index(info)
+            self.by_name.setdefault(flavor.name, flavor)
+        for info in self.fetched:
+            self._index(info)
+
+    def _index(self, info):
+        manager = self.client.flavors
+        flavor = manager.resource_class(manager, info, loaded=True)
+        self.by_id[flavor.id] = flavor
+        return flavor
+
+    def __contains__(self, flavor_id):
+        return flavor_id in self.by_id
+
+    def __getitem__(self, flavor_id):
+        return self.by_id[flavor_id]
+
+    def get(self, flavor_id, default=None):
+        return self.by_id.get(flavor_id, default)
+
+    def find(self, name_or_id):
+        return self.by_name.get(name_or_id) or self.by_id.get(name_or_id)
+
+    def fetch(self, flavor_ids, concurrency=8):
+        """Fetch the flavors with the given ids that aren't known yet,
+        concurrency at a time.  Returns the ids that nova can't find, which
+        aren't asked for again.
+        """
+        def get(flavor_id):
+            try:
+                return flavor_id, self.client.flavors.get(flavor_id)
+            except nova_exceptions.NotFound:
+                return flavor_id, None
+
+        missing = set(flavor_ids) - set(self.by_id) - self.not_found
+        if not missing:
+            # Don't pay for starting a thread pool with nothing to do
+            return []
+        not_found = []
+        for flavor_id, flavor in workers.imap(get, missing, concurrency):
+            if flavor is None:
+                not_found.append(flavor_id)
+                self.not_found.add(flavor_id)
+                continue
+            info = flavor.to_dict()
+            self.fetched.append(info)
+            self._index(info)
+        if len(not_found) < len(missing):
+            cache.save(self.key, {'listed': self.listed,
+                                  'fetched': self.fetched})
+        return not_found
+
+
 def get_flavor_id(client, flavor_name):
-    flavors = client.flavors.list()
-    for flavor in flavors:
-        if flavor.name == flavor_name:
-            return flavor.id
-    raise Exception("Can't find flavor %s" % flavor_name)
+    flavor = FlavorCache(client).find(flavor_name)
+    if flavor is None:
+        flavor = FlavorCache(client, refresh=True).find(flavor_name)
+    if flavor is None:
+        raise Exception("Can't find flavor %s" % flavor_name)
+    return flavor.id
+
+
+def list_servers(client, search_opts=None, page_size=1000):
+    """Iterate over all servers matching search_opts, fetching them a page
+    at a time with marker/limit pagination.
+    """
+    marker = None
+    while True:
+        page = client.servers.list(detailed=True, search_opts=search_opts,
+                                   marker=marker, limit=page_size)
+        if not page:
+            break
+        for server in page:
+            yield server
+        marker = page[-1].id
 
 
 def wait_for(func, error_message):
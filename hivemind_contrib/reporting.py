@@ -1,43 +1,109 @@
+import array
 import os
 import sys
 import csv
 import datetime
+import gzip
+import hashlib
+import itertools
 import requests
 import traceback
+import urllib
 import logging
+import threading
 from fabric.api import task
+from novaclient import exceptions as nova_exceptions
 import collections
 from prettytable import PrettyTable
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 import hivemind_contrib.keystone as hm_keystone
 import hivemind_contrib.nova as hm_nova
+from hivemind_contrib import cache
+from hivemind_contrib import instrumentation
+from hivemind_contrib.ledger import UsageLedger
+from hivemind_contrib import workers
 
 from hivemind.decorators import verbose
 
 
-def csv_output(headings, rows, filename=None):
+def _open_output(filename):
+    """Open filename for writing, gzip compressed if it ends in .gz, or
+    return stdout if there is no filename.
+    """
     if filename is None:
-        fp = sys.stdout
-    else:
-        fp = open(filename, 'wb')
-    csv_output = csv.writer(fp, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    csv_output.writerow(headings)
-    for row in rows:
-        csv_output.writerow(map(lambda x: unicode(x).encode('utf-8'), row))
-    if filename is not None:
-        fp.close()
+        return sys.stdout
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wb')
+    return open(filename, 'wb')
+
+
+def csv_output(headings, rows, filename=None):
+    """Write rows as CSV.  rows may be any iterable; each row is written
+    as soon as it is produced, and stdout is flushed as it goes.
+    """
+    fp = _open_output(filename)
+    try:
+        csv_output = csv.writer(fp, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        csv_output.writerow(headings)
+        for row in rows:
+            csv_output.writerow(
+                map(lambda x: unicode(x).encode('utf-8'), row))
+            if filename is None:
+                fp.flush()
+    finally:
+        if filename is not None:
+            fp.close()
 
 
 def pretty_output(headings, rows, filename=None):
-    if filename is None:
-        fp = sys.stdout
-    else:
-        fp = open(filename, 'wb')
+    """Write rows as a table.  PrettyTable has to see every row before it
+    can size the columns, so use csv_output for large reports.
+    """
     pp = PrettyTable(headings)
     for r in rows:
         pp.add_row(r)
-    print >> fp, str(pp)
+    fp = _open_output(filename)
+    try:
+        print >> fp, str(pp)
+    finally:
+        if filename is not None:
+            fp.close()
+
+
+class Crosstab(object):
+    """Pivot (row, column, value) cells into a table.
+
+    Columns are numbered in the order they are first seen, and each row
+    is a list of cells indexed by column number, so adding a cell is
+    constant time however many columns there are.  Cells that are never
+    set hold default.  Iterating yields (row key, cells) in the order
+    the rows were first seen.
+    """
+    def __init__(self, default=None):
+        self.default = default
+        self.columns = []
+        self.column_index = {}
+        self.rows = collections.OrderedDict()
+
+    def add(self, row_key, column, value):
+        index = self.column_index.get(column)
+        if index is None:
+            index = self.column_index[column] = len(self.columns)
+            self.columns.append(column)
+        cells = self.rows.get(row_key)
+        if cells is None:
+            cells = self.rows[row_key] = []
+        if len(cells) <= index:
+            cells.extend([self.default] * (index + 1 - len(cells)))
+        cells[index] = value
+
+    def __iter__(self):
+        width = len(self.columns)
+        for row_key, cells in self.rows.iteritems():
+            yield row_key, cells + [self.default] * (width - len(cells))
 
 
 def ssl_warnings(enabled=False):
@@ -45,38 +111,50 @@ def ssl_warnings(enabled=False):
         logging.captureWarnings(True)
 
 
-@task
-@verbose
-def allocation_homes(csv=False, filename=None, sslwarnings=False):
-    """Get the allocation_homes for all projects. If this
-metadata field is not set in keystone (see keystone hivemind
-commands), the value reported is the email domains for all
-tenant managers belonging to this project.
+ALLOCATION_CONTACT_COLUMNS = collections.OrderedDict([
+    ('homes', "Allocation Home(s)"),
+    ('managers', "Manager email(s)"),
+])
+
+
+def _allocation_contacts(directory, columns):
+    """Yield [tenant id, column...] for each project with something to
+    report in the given columns.  'homes' is the project's allocation_home,
+    or failing that the email domains of its tenant managers; 'managers' is
+    the tenant managers' emails.
     """
+    emails = directory.user_emails()
+    managers = directory.project_managers()
+    for proj in directory.projects():
+        manager_emails = [emails[tm] for tm in managers.get(proj.id, [])
+                          if tm in emails]
+        has_managers = proj.id in managers
+        row = [proj.id]
+        reported = False
+        for column in columns:
+            if column == 'homes' and "allocation_home" in proj.to_dict():
+                row.append(proj.allocation_home)
+            elif column == 'homes' and has_managers:
+                row.append(",".join(set(
+                    email.split("@")[-1] for email in manager_emails)))
+            elif column == 'managers' and has_managers:
+                row.append(",".join(set(manager_emails)))
+            else:
+                row.append("")
+                continue
+            reported = True
+        if reported:
+            yield row
+
+
+def _allocation_contacts_output(columns, csv, filename, sslwarnings,
+                                refresh):
     ssl_warnings(enabled=sslwarnings)
     keystone = hm_keystone.client_session(version=3)
-    all_users = map(lambda x: x.to_dict(), keystone.users.list())
-    email_dict = {x['id']: x['email'].split("@")[-1] for x in all_users
-                  if 'email' in x and x['email'] is not None}
-    projects = keystone.projects.list()
-    managers = collections.defaultdict(list)
-    for user_role in keystone.role_assignments.list(role=14):
-        if 'project' in user_role.scope:
-            managers[user_role.scope['project']['id']].append(
-                user_role.user['id'])
-    headings = ["Tenant ID", "Allocation Home(s)"]
-    records = []
-    for proj in projects:
-        if "allocation_home" in proj.to_dict():
-            records.append([proj.id, proj.allocation_home])
-        else:
-            if len(managers[proj.id]) == 0:
-                continue
-            institutions = set()
-            for tm in managers[proj.id]:
-                if tm in email_dict:
-                    institutions.add(email_dict[tm])
-            records.append([proj.id, ",".join(institutions)])
+    directory = hm_keystone.Directory(keystone, refresh=refresh)
+    headings = ["Tenant ID"]
+    headings.extend(ALLOCATION_CONTACT_COLUMNS[c] for c in columns)
+    records = _allocation_contacts(directory, columns)
     if csv:
         csv_output(headings, records, filename=filename)
     else:
@@ -85,43 +163,152 @@ tenant managers belonging to this project.
 
 @task
 @verbose
-def allocation_managers(csv=False, filename=None, sslwarnings=False):
+def allocation_homes(csv=False, filename=None, sslwarnings=False,
+                     refresh=False):
+    """Get the allocation_homes for all projects. If this
+metadata field is not set in keystone (see keystone hivemind
+commands), the value reported is the email domains for all
+tenant managers belonging to this project.
+    """
+    _allocation_contacts_output(['homes'], csv, filename, sslwarnings,
+                                refresh)
+
+
+@task
+@verbose
+def allocation_managers(csv=False, filename=None, sslwarnings=False,
+                        refresh=False):
     """Get the allocation manager emails for all projects.
     """
-    ssl_warnings(enabled=sslwarnings)
-    keystone = hm_keystone.client_session(version=3)
-    all_users = map(lambda x: x.to_dict(), keystone.users.list())
-    email_dict = {x['id']: x['email'] for x in all_users
-                  if 'email' in x and x['email'] is not None}
-    projects = keystone.projects.list()
-    managers = collections.defaultdict(list)
-    for user_role in keystone.role_assignments.list(role=14):
-        if 'project' in user_role.scope:
-            managers[user_role.scope['project']['id']].append(
-                user_role.user['id'])
-    headings = ["Tenant ID", "Manager email(s)"]
-    records = []
-    for proj in projects:
-        if len(managers[proj.id]) == 0:
-            continue
-        emails = set()
-        for tm in managers[proj.id]:
-            if tm in email_dict:
-                emails.add(email_dict[tm])
-        records.append([proj.id, ",".join(emails)])
-    if csv:
-        csv_output(headings, records, filename=filename)
+    _allocation_contacts_output(['managers'], csv, filename, sslwarnings,
+                                refresh)
+
+
+@task
+@verbose
+def allocation_contacts(columns='homes+managers', csv=False, filename=None,
+                        sslwarnings=False, refresh=False):
+    """Get the allocation homes and manager emails for all projects in a
+single pass.  columns is a '+' separated selection of homes and managers.
+    """
+    columns = [c for c in columns.split('+') if c]
+    for column in columns:
+        if column not in ALLOCATION_CONTACT_COLUMNS:
+            print 'Unknown column {0}, expected one of {1}'.format(
+                column, ', '.join(ALLOCATION_CONTACT_COLUMNS))
+            return
+    _allocation_contacts_output(columns, csv, filename, sslwarnings,
+                                refresh)
+
+
+USAGE_WINDOWS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1),
+}
+
+
+def _split_period(start, end, window):
+    """Split start to end into consecutive windows of the given size,
+    either 'day', 'week' or a number of days.
+    """
+    if window in USAGE_WINDOWS:
+        step = USAGE_WINDOWS[window]
     else:
-        pretty_output(headings, records, filename=filename)
+        step = datetime.timedelta(days=float(window))
+    assert step > datetime.timedelta(0)
+    while start < end:
+        yield start, min(start + step, end)
+        start += step
+
+
+def _get_usage_totals(nova, start, end, window=None, concurrency=1,
+                      retries=3):
+    """Get the accumulated usage per tenant between start and end.
+
+    With a window the period is fetched as separate windows, up to
+    concurrency at a time, each retried on its own if it fails.  Nova
+    clips every instance's usage to the requested period, so summing the
+    windows gives the same totals as a single request.  Returns an
+    ordered dict of tenant id to [instance ids, instance hours, vCPU
+    hours, memory hours, disk hours].
+    """
+    if window is None:
+        periods = [(start, end)]
+    else:
+        periods = _split_period(start, end, window)
+
+    def fetch(period):
+        return workers.retry(
+            lambda: nova.usage.list(period[0], period[1], detailed=True),
+            attempts=retries)
+
+    totals = collections.OrderedDict()
+    for usages in workers.imap(fetch, periods, concurrency):
+        for u in usages:
+            if u.tenant_id not in totals:
+                totals[u.tenant_id] = [set(), 0, 0, 0, 0]
+            total = totals[u.tenant_id]
+            total[0].update(iu['instance_id'] for iu in u.server_usages)
+            total[1] += u.total_hours
+            total[2] += u.total_vcpus_usage
+            total[3] += u.total_memory_mb_usage
+            total[4] += u.total_local_gb_usage
+    return totals
+
+
+def _ledger_days(start, end):
+    """The whole days covering start to end.  An end that isn't at
+    midnight is rounded up to the next day, so that its last day is
+    reported as it is when usage is fetched live.
+    """
+    end_day = end.date()
+    if end.time() != datetime.time():
+        end_day += datetime.timedelta(days=1)
+    return start.date(), end_day
+
+
+def _sync_ledger(path, nova, start, end, concurrency=1, retries=3,
+                 rate_limit=None, locate=False):
+    """Bring the usage ledger at path up to date for the whole days from
+    start to end, returning the ledger and the first and last day.  The
+    availability zones of the instances are only looked up if locate is
+    set, as only the instance report needs them, concurrency instances
+    at a time.  Zones that can't be found are left empty, to be looked
+    up again next time.
+    """
+    usage_ledger = UsageLedger(path)
+    start_day, end_day = _ledger_days(start, end)
+    today = datetime.datetime.utcnow().date()
+    if end_day > today:
+        print >> sys.stderr, 'The ledger only holds complete days, so ' \
+            'usage from {0} on is left out'.format(today)
+    fetched = usage_ledger.sync(nova, start_day, end_day,
+                                concurrency=concurrency, retries=retries)
+    print >> sys.stderr, 'Fetched {0} days of usage into {1}'.format(
+        fetched, path)
+    if locate:
+        locator = _instance_locator(
+            nova, workers.RateLimiter(rate_limit),
+            datetime.datetime.combine(start_day, datetime.time()),
+            default=None)
+        usage_ledger.locate_instances(start_day, end_day, locator,
+                                      concurrency=concurrency)
+    return usage_ledger, start_day, end_day
 
 
 @task
 @verbose
 def get_project_usage_csv(start_date=None, end_date=None,
-                          filename=None, sslwarnings=False):
+                          filename=None, sslwarnings=False,
+                          window=None, concurrency=1, retries=3,
+                          ledger=None, refresh=False):
     """Get accumulated instance usage statistics for all projects.
     Date strings should be ISO 8601 to minute precision
-    without timezone information.
+    without timezone information.  Long periods can be fetched in
+    windows ('day', 'week' or a number of days), concurrency windows
+    at a time.  With a ledger file, usage is kept in a local SQLite
+    ledger by whole UTC day and only days not already stored are
+    fetched; the current day isn't complete yet, so it is left out.
     """
     ssl_warnings(enabled=sslwarnings)
     assert start_date and end_date
@@ -130,76 +317,103 @@ def get_project_usage_csv(start_date=None, end_date=None,
     keystone = hm_keystone.client_session(version=3)
     nova = hm_nova.client()
 
-    tenants = {x.id: x for x in keystone.projects.list()}
+    tenants = {x.id: x for x in
+               hm_keystone.Directory(keystone, refresh=refresh).projects()}
     headings = ["Tenant ID", "Tenant Name", "Instance count",
                 "Instance hours", "vCPU hours", "Memory Hours (MB)",
                 "Disk hours (GB)"]
-    usage = map(lambda u: [
-                u.tenant_id,
-                tenants[u.tenant_id].name if u.tenant_id in tenants else None,
-                len(u.server_usages),
-                u.total_hours,
-                u.total_vcpus_usage,
-                u.total_memory_mb_usage,
-                u.total_local_gb_usage],
-                nova.usage.list(start, end, detailed=True))
+    if ledger is not None:
+        usage_ledger, start_day, end_day = _sync_ledger(
+            ledger, nova, start, end, concurrency=concurrency,
+            retries=retries)
+        totals = usage_ledger.tenant_totals(start_day, end_day)
+    else:
+        totals = ([tenant_id, len(total[0])] + total[1:]
+                  for tenant_id, total in _get_usage_totals(
+                      nova, start, end, window=window,
+                      concurrency=concurrency,
+                      retries=retries).iteritems())
+    usage = itertools.imap(lambda total: [
+                total[0],
+                tenants[total[0]].name if total[0] in tenants else None,
+                total[1],
+                total[2],
+                total[3],
+                total[4],
+                total[5]],
+                totals)
     csv_output(headings, usage, filename=filename)
 
 
 @task
 @verbose
 def get_instance_usage_csv(start_date=None, end_date=None,
-                           filename=None, sslwarnings=False):
+                           filename=None, sslwarnings=False,
+                           concurrency=1, rate_limit=None, ledger=None,
+                           refresh=False, rollup=None):
     """Get individual instance usage for all projects, including tenant and
     availability zones.  Date strings should be ISO 8601 to minute precision
-    without timezone information.
+    without timezone information.  Up to concurrency tenants are resolved
+    at once, with live instance lookups limited to rate_limit requests
+    per second.  Deleted instances are indexed up front with one paginated
+    sweep of the servers deleted since start_date.  With a ledger file,
+    usage is kept in a local SQLite ledger by whole UTC day and only days
+    not already stored are fetched; the current day isn't complete yet,
+    so it is left out.  rollup reports usage totals grouped by a
+    '+' separated selection of az, flavor and tenant instead of one row
+    per instance.
     """
     ssl_warnings(enabled=sslwarnings)
     assert start_date and end_date
+    if rollup is not None:
+        group_by = rollup.split('+')
+        for field in group_by:
+            assert field in UsageRollup.FIELDS, \
+                'Unknown rollup field {0}'.format(field)
     start = datetime.datetime.strptime(start_date, "%Y-%m-%dT%H:%M")
     end = datetime.datetime.strptime(end_date, "%Y-%m-%dT%H:%M")
     keystone = hm_keystone.client_session(version=3)
     nova = hm_nova.client()
 
-    tenants = {x.id: x for x in keystone.projects.list()}
-    usage = []
-    for u in nova.usage.list(start, end, detailed=True):
-        tenant_id = u.tenant_id
-        tenant_name = tenants[tenant_id].name if tenant_id in tenants else None
-
-        # The Nova API doesn't allow "show" on deleted instances, but
-        # we can get the info using "list --deleted".  The problem is
-        # figuring out how to avoid retrieving irrelevant instances,
-        # and at the same time how to avoid too many requests.
-        #
-        # Attempt #1 - use the tenant_id and the instance's name to
-        # focus queries.
-        # Attempt #2 - as #1, but after N lookups by name for a tenant,
-        # just fetch all of the deleted instances.
-        cache = {}
-        try:
-            for iu in u.server_usages:
-                name = iu['name']
-                instance_id = iu['instance_id']
-                instance = None
-                if iu['state'] == 'terminated' or iu['state'] == 'deleted':
-                    instance = _get_deleted_instance(cache, nova, u.tenant_id,
-                                                     name, instance_id)
-                else:
-                    try:
-                        instance = nova.servers.get(instance_id).to_dict()
-                    except:
-                        print 'Cannot find instance {0} in {1}' \
-                            .format(instance_id, u.tenant_id)
-                if instance is None:
-                    instance = {'OS-EXT-AZ:availability_zone': 'unknown'}
-
-                usage.append([tenant_id, tenant_name, instance_id, name,
-                              iu['state'], iu['flavor'], iu['hours'],
-                              iu['vcpus'], iu['memory_mb'], iu['local_gb'],
-                              instance['OS-EXT-AZ:availability_zone']])
-        except:
-            traceback.print_exc(file=sys.stdout)
+    tenants = {x.id: x for x in
+               hm_keystone.Directory(keystone, refresh=refresh).projects()}
+    if ledger is not None:
+        usage_ledger, start_day, end_day = _sync_ledger(
+            ledger, nova, start, end, concurrency=concurrency,
+            rate_limit=rate_limit, locate=True)
+        usage = itertools.imap(
+            lambda iu: _instance_usage_row(
+                tenants, iu['tenant_id'], iu,
+                iu['availability_zone'] or 'unknown'),
+            usage_ledger.instance_totals(start_day, end_day))
+    else:
+        locate = _instance_locator(nova, workers.RateLimiter(rate_limit),
+                                   start)
+        usage = itertools.chain.from_iterable(workers.imap(
+            lambda u: _get_tenant_instance_usage(locate, tenants, u),
+            nova.usage.list(start, end, detailed=True),
+            concurrency))
+
+    if rollup is not None:
+        totals = UsageRollup()
+        for row in usage:
+            totals.add(row[10], row[5], row[0],
+                       row[6], row[7], row[8], row[9])
+        headings = [UsageRollup.FIELDS[field] for field in group_by]
+        rows = totals.summary(group_by)
+        if 'tenant' in group_by:
+            # Follow the tenant id with its name, as the detailed report does
+            position = group_by.index('tenant')
+            headings.insert(position + 1, "Tenant Name")
+            rows = itertools.imap(
+                lambda row: row[:position + 1] + [
+                    tenants[row[position]].name
+                    if row[position] in tenants else None] +
+                row[position + 1:],
+                rows)
+        headings.extend(UsageRollup.METRICS)
+        csv_output(headings, rows, filename=filename)
+        return
 
     headings = ["Tenant ID", "Tenant Name", "Instance id", "Instance name",
                 "Instance state", "Flavour",
@@ -207,78 +421,274 @@ def get_instance_usage_csv(start_date=None, end_date=None,
     csv_output(headings, usage, filename=filename)
 
 
-def _get_deleted_instance(cache, nova, tenant_id, name, instance_id):
-    if name in cache:
-        instances = cache[name]
-    elif len(cache) < 4:        # N == 4 ...
-        try:
-            instances = nova.servers.list(
-                detailed=True,
-                search_opts={'deleted': True,
-                             'all_tenants': True,
-                             'tenant_id': tenant_id,
-                             'name': name})
-            if len(instances) == 0:
-                print "No deleted '{0}' instances in {1}".format(name,
-                                                                 tenant_id)
-        except:
-            print "Can't get deleted '{0}' instances in {1}".format(name,
-                                                                    tenant_id)
-            traceback.print_exc(file=sys.stdout)
-            instances = []
-        cache[name] = instances
-    elif '*-*-ALL-*-*' in cache:
-        instances = cache['*-*-ALL-*-*']
-    else:
-        try:
-            instances = nova.servers.list(
-                detailed=True,
-                search_opts={'deleted': True,
-                             'all_tenants': True,
-                             'tenant_id': tenant_id})
-            if len(instances) == 0:
-                print "No deleted instances in {0}".format(tenant_id)
-        except:
-            print "Can't get deleted instances in {0}".format(tenant_id)
-            traceback.print_exc(file=sys.stdout)
-            instances = []
-        cache['*-*-ALL-*-*'] = instances
-    if len(instances) == 0:
-        return None
+class UsageRollup(object):
+    """Running instance usage totals keyed by (AZ, flavor, tenant).
+
+    Each metric is a compact numeric array indexed by key number, so only
+    one set of totals per distinct key is kept however many instance rows
+    are added.
+    """
+    FIELDS = collections.OrderedDict([
+        ('az', "AZ"),
+        ('flavor', "Flavour"),
+        ('tenant', "Tenant ID"),
+    ])
+    METRICS = ["Instances", "Instance hours", "vCPU hours",
+               "Memory hours (MB)", "Disk hours (GB)"]
+
+    def __init__(self):
+        self.keys = []
+        self.key_index = {}
+        self.instances = array.array('l')
+        self.hours = array.array('d')
+        self.vcpu_hours = array.array('d')
+        self.memory_hours = array.array('d')
+        self.disk_hours = array.array('d')
+
+    def add(self, az, flavor, tenant_id, hours, vcpus, memory_mb, local_gb):
+        key = (az, flavor, tenant_id)
+        index = self.key_index.get(key)
+        if index is None:
+            index = self.key_index[key] = len(self.keys)
+            self.keys.append(key)
+            self.instances.append(0)
+            for column in (self.hours, self.vcpu_hours,
+                           self.memory_hours, self.disk_hours):
+                column.append(0.0)
+        hours = float(hours)
+        self.instances[index] += 1
+        self.hours[index] += hours
+        self.vcpu_hours[index] += hours * vcpus
+        self.memory_hours[index] += hours * memory_mb
+        self.disk_hours[index] += hours * local_gb
+
+    def summary(self, group_by):
+        """Yield [group fields..., metrics...] for the totals grouped by
+        the given list of FIELDS, sorted by group.
+        """
+        positions = [self.FIELDS.keys().index(field) for field in group_by]
+        groups = {}
+        columns = (self.instances, self.hours, self.vcpu_hours,
+                   self.memory_hours, self.disk_hours)
+        for index, key in enumerate(self.keys):
+            group = tuple(key[position] for position in positions)
+            totals = groups.get(group)
+            if totals is None:
+                totals = groups[group] = [0, 0.0, 0.0, 0.0, 0.0]
+            for metric, column in enumerate(columns):
+                totals[metric] += column[index]
+        for group in sorted(groups):
+            yield list(group) + groups[group]
+
+
+def _instance_usage_row(tenants, tenant_id, iu, az):
+    tenant_name = tenants[tenant_id].name if tenant_id in tenants else None
+    return [tenant_id, tenant_name, iu['instance_id'], iu['name'],
+            iu['state'], iu['flavor'], iu['hours'],
+            iu['vcpus'], iu['memory_mb'], iu['local_gb'], az]
+
+
+def _get_tenant_instance_usage(locate, tenants, u):
+    usage = []
     try:
-        filter(
-            lambda i: i.id == instance_id,
-            instances)[0].to_dict()
+        for iu in u.server_usages:
+            usage.append(_instance_usage_row(tenants, u.tenant_id, iu,
+                                             locate(u.tenant_id, iu)))
     except:
-        print 'Cannot find deleted instance {0} in {1}'.format(instance_id,
-                                                               tenant_id)
-        return None
+        traceback.print_exc(file=sys.stdout)
+    return usage
+
+
+def _instance_locator(nova, limiter, since, default='unknown'):
+    """Return a function that finds the availability zone of the instance
+    in a server usage record.  Live instances are looked up one at a time,
+    at most limiter allows, and remembered.  Deleted instances come from
+    an index of every instance deleted since the given time, built the
+    first time it is needed, and live instances that nova no longer
+    has are looked for there too, as they may have been deleted since
+    their usage was recorded.  If the index can't be built the deleted
+    instances aren't found, rather than failing the lookups.  Instances
+    that can't be found are in the default zone.
+    """
+    lock = threading.Lock()
+    live = {}
+    deleted = []
+
+    def deleted_zone(instance_id):
+        with lock:
+            if not deleted:
+                try:
+                    deleted.append(workers.retry(
+                        lambda: _get_deleted_instances(nova, since),
+                        jitter=1))
+                except Exception as e:
+                    print 'Cannot list deleted instances: {0}'.format(e)
+                    deleted.append({})
+        return deleted[0].get(instance_id)
+
+    def locate(tenant_id, iu):
+        instance_id = iu['instance_id']
+        az = None
+        if iu['state'] == 'terminated' or iu['state'] == 'deleted':
+            az = deleted_zone(instance_id)
+            if az is None:
+                print 'Cannot find deleted instance {0} in {1}' \
+                    .format(instance_id, tenant_id)
+        elif instance_id in live:
+            az = live[instance_id]
+        else:
+            try:
+                limiter.wait()
+                instance = nova.servers.get(instance_id).to_dict()
+                az = instance['OS-EXT-AZ:availability_zone']
+            except nova_exceptions.NotFound:
+                az = deleted_zone(instance_id)
+                if az is None:
+                    print 'Cannot find instance {0} in {1}' \
+                        .format(instance_id, tenant_id)
+            except:
+                print 'Cannot find instance {0} in {1}' \
+                    .format(instance_id, tenant_id)
+            live[instance_id] = az
+        if az is None:
+            az = default
+        return az
+    return locate
+
+
+def _get_deleted_instances(nova, since, page_size=1000):
+    """Map the id of every instance deleted since the given time to its
+    availability zone.
+
+    The Nova API doesn't allow "show" on deleted instances, but they
+    can be listed with "list --deleted".  Any instance that was running
+    during a report window was deleted after the start of the window,
+    so a single changes-since sweep covers every deleted instance in
+    the report.
+    """
+    search_opts = {'deleted': True,
+                   'all_tenants': True,
+                   'changes-since': since.isoformat()}
+    deleted = {}
+    for server in hm_nova.list_servers(nova, search_opts=search_opts,
+                                       page_size=page_size):
+        deleted[server.id] = getattr(server,
+                                     'OS-EXT-AZ:availability_zone', None)
+    return deleted
 
 
 class NectarApiSession(requests.Session):
     """Class to encapsulate the rest api endpoint with a requests session.
+
+    Connections are pooled and failed requests retried with backoff.
+    Responses that carry an ETag or Last-Modified header are kept in the
+    local cache and revalidated on the next request, and paginated
+    listings are followed page by page.
     """
     def __init__(self, api_url=None, api_username=None,
-                 api_password=None, *args, **kwargs):
+                 api_password=None, retries=3, pool_size=10,
+                 *args, **kwargs):
         username = os.environ.get('NECTAR_ALLOCATIONS_USERNAME', api_username)
         password = os.environ.get('NECTAR_ALLOCATIONS_PASSWORD', api_password)
         self.api_url = os.environ.get('NECTAR_ALLOCATIONS_URL', api_url)
         assert username and password and self.api_url
         requests.Session.__init__(self, *args, **kwargs)
         self.auth = (username, password)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=Retry(
+                                  total=retries, backoff_factor=1,
+                                  status_forcelist=[500, 502, 503, 504]))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
     def _api_get(self, rel_url, *args, **kwargs):
         return self.get("%s%s" % (self.api_url, rel_url), *args, **kwargs)
 
-    def get_allocations(self):
-        req = self._api_get('/rest_api/allocations')
+    def _cached_get(self, url):
+        key = 'nectar-api-%s' % hashlib.md5(
+            "%s %s" % (self.auth[0], url)).hexdigest()
+        cached = cache.load(key)
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        req = self.get(url, headers=headers)
+        if req.status_code == 304 and cached is not None:
+            return cached['body']
+        req.raise_for_status()
+        body = req.json()
+        etag = req.headers.get('ETag')
+        last_modified = req.headers.get('Last-Modified')
+        if etag or last_modified:
+            cache.save(key, {'etag': etag, 'last_modified': last_modified,
+                             'body': body})
+        return body
+
+    def _get_json(self, url):
+        req = self.get(url)
         req.raise_for_status()
         return req.json()
 
+    def _api_list(self, rel_url, params=None):
+        """Yield the records of a listing, following the 'next' links of
+        a paginated response.  Unfiltered listings are revalidated against
+        the local cache.  Listings filtered with params are fetched
+        directly, as every new filter would leave another copy in the
+        cache.
+        """
+        url = "%s%s" % (self.api_url, rel_url)
+        if params:
+            url += '?' + urllib.urlencode(params)
+        while url:
+            if params:
+                body = self._get_json(url)
+            else:
+                body = self._cached_get(url)
+            if isinstance(body, dict) and 'results' in body:
+                for record in body['results']:
+                    yield record
+                url = body.get('next')
+            else:
+                for record in body:
+                    yield record
+                url = None
+
+    def iter_allocations(self, modified_since=None):
+        """Yield allocation records, only those modified at or after
+        modified_since if given and the API supports filtering on it.
+        """
+        params = None
+        if modified_since is not None:
+            params = {'modified_time__gte': modified_since}
+        return self._api_list('/rest_api/allocations', params)
+
+    def iter_quotas(self):
+        return self._api_list('/rest_api/quotas')
+
+    def get_allocations(self):
+        return list(self.iter_allocations())
+
     def get_quotas(self):
-        req = self._api_get('/rest_api/quotas')
-        req.raise_for_status()
-        return req.json()
+        return list(self.iter_quotas())
+
+
+_api_sessions = {}
+_api_sessions_lock = threading.Lock()
+
+
+def api_session(api_url=None, api_username=None, api_password=None):
+    """Return the NectarApiSession shared by the whole process."""
+    key = (api_url, api_username, api_password)
+    with _api_sessions_lock:
+        if key not in _api_sessions:
+            _api_sessions[key] = instrumentation.wrap(
+                NectarApiSession(api_url, api_username, api_password),
+                'allocations')
+        return _api_sessions[key]
 
 
 @task
@@ -287,7 +697,7 @@ def get_general_allocations_information(filename=None, sslwarnings=False):
     """Get standard allocations information and global quotas for all projects.
     """
     ssl_warnings(enabled=sslwarnings)
-    api_endpoint = NectarApiSession()
+    api_endpoint = api_session()
     allocations = api_endpoint.get_allocations()
     fields_to_report = [
         ("Tenant ID", lambda x: x['tenant_uuid']),
@@ -310,7 +720,7 @@ def get_general_allocations_information(filename=None, sslwarnings=False):
         ]
 
     csv_output(map(lambda x: x[0], fields_to_report),
-               map(lambda alloc: map(
+               itertools.imap(lambda alloc: map(
                    lambda y: y[1](alloc),
                    fields_to_report),
                    allocations),
@@ -321,32 +731,30 @@ def get_general_allocations_information(filename=None, sslwarnings=False):
 @verbose
 def get_local_allocations_information(filename=None, availability_zone=None,
                                       sslwarnings=False):
-    """Get local quota information for all projects.
+    """Get local quota information for all projects.  availability_zone
+    may be a '+' separated list of zones.
     """
     ssl_warnings(enabled=sslwarnings)
-    api_endpoint = NectarApiSession()
-    allocations = {x['id']: x for x in api_endpoint.get_allocations()}
-    quotas = {}
-    quota_fields = []
-    for q in api_endpoint.get_quotas():
-        if q['zone'] != availability_zone and availability_zone is not None:
+    api_endpoint = api_session()
+    allocations = {x['id']: x for x in api_endpoint.iter_allocations()}
+    zones = None
+    if availability_zone is not None:
+        zones = set(availability_zone.split('+'))
+    quotas = Crosstab(default=0)
+    for q in api_endpoint.iter_quotas():
+        if zones is not None and q['zone'] not in zones:
             continue
-        if q['allocation'] not in quotas:
-            quotas[q['allocation']] = collections.defaultdict(int)
-        qf = "%(zone)s-%(resource)s (%(units)s)" % q
-        quotas[q['allocation']][qf] = "%(quota)s" % q
-        if qf not in quota_fields:
-            quota_fields.append(qf)
+        quotas.add(q['allocation'],
+                   "%(zone)s-%(resource)s (%(units)s)" % q,
+                   "%(quota)s" % q)
 
     fields_to_report = ["Tenant ID", "Tenant Name"]
-    fields_to_report.extend(quota_fields)
+    fields_to_report.extend(quotas.columns)
 
-    data_to_report = []
-    for a_id in quotas:
+    def report_row((a_id, cells)):
         alloc = allocations[a_id]
-        row = [alloc['tenant_uuid'],
-               alloc['project_name'] if alloc['tenant_name'] is None
-               else alloc['tenant_name']]
-        row.extend(map(lambda x: quotas[a_id][x], quota_fields))
-        data_to_report.append(row)
-    csv_output(fields_to_report, data_to_report, filename=filename)
+        return [alloc['tenant_uuid'],
+                alloc['project_name'] if alloc['tenant_name'] is None
+                else alloc['tenant_name']] + cells
+    csv_output(fields_to_report, itertools.imap(report_row, quotas),
+               filename=filename)
@@ -1,4 +1,5 @@
 import os
+import threading
 
 from fabric.api import parallel, puts, env, task
 from fabric.colors import red, blue
@@ -9,6 +10,14 @@ from hivemind import util, puppet, apt
 from hivemind.decorators import configurable
 from hivemind.operations import run
 
+from hivemind_contrib import instrumentation
+
+
+# A Connection keeps its token, re-authenticating when it expires, but
+# its HTTP connection can't be shared between threads, so each thread
+# keeps its own.
+_connections = threading.local()
+
 
 @configurable('nectar.openstack.client')
 def client(url=None, username=None, password=None, tenant=None):
@@ -17,11 +26,18 @@ def client(url=None, username=None, password=None, tenant=None):
     password = os.environ.get('OS_PASSWORD', password)
     tenant = os.environ.get('OS_TENANT_NAME', tenant)
     assert url and username and password and tenant
-    return swift_client.Connection(authurl=url,
-                                   user=username,
-                                   key=password,
-                                   tenant_name=tenant,
-                                   auth_version=2)
+    if not hasattr(_connections, 'by_credentials'):
+        _connections.by_credentials = {}
+    key = (url, username, password, tenant)
+    if key not in _connections.by_credentials:
+        _connections.by_credentials[key] = instrumentation.wrap(
+            swift_client.Connection(authurl=url,
+                                    user=username,
+                                    key=password,
+                                    tenant_name=tenant,
+                                    auth_version=2),
+            'swift')
+    return _connections.by_credentials[key]
 
 
 def list_service():
@@ -0,0 +1,63 @@
+"""Helpers for spreading OpenStack API calls over a bounded pool of
+threads without hammering any one endpoint.
+"""
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class RateLimiter(object):
+    """Allow at most ``rate`` calls per second to :meth:`wait`, shared
+    between all of the threads using the limiter.  A ``rate`` of None
+    (or 0) disables the limit.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / float(rate) if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def imap(func, iterable, concurrency=1):
+    """Apply func to each item of iterable using up to ``concurrency``
+    threads, yielding the results in the same order as the input.
+    """
+    concurrency = int(concurrency)
+    if concurrency <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    pool = ThreadPool(concurrency)
+    try:
+        for result in pool.imap(func, iterable):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def retry(func, attempts=3, delay=1, backoff=2, jitter=0,
+          exceptions=(Exception,)):
+    """Call func until it succeeds, at most ``attempts`` times.  Failures
+    matching ``exceptions`` are retried after ``delay`` seconds (plus up to
+    ``jitter`` random seconds), with the delay multiplied by ``backoff``
+    after each attempt.  The last failure is re-raised.
+    """
+    attempts = int(attempts)
+    for attempt in range(attempts):
+        try:
+            return func()
+        except exceptions:
+            if attempt >= attempts - 1:
+                raise
+            time.sleep(delay + random.uniform(0, jitter))
+            delay *= backoff
@@ -25,7 +25,8 @@ setup(
     author='Russell Sim',
     author_email='russell.sim@gmail.com',
     url='https://github.com/NeCTAR-RC/hivemind_contrib',
-    packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+    packages=find_packages(exclude=['ez_setup', 'examples', 'tests',
+                                    'benchmarks']),
     include_package_data=True,
     install_requires=requirements,
     license="GPLv2",
@@ -0,0 +1,258 @@
+import tempfile
+import unittest
+
+import mock
+from novaclient import exceptions as nova_exceptions
+
+from hivemind_contrib import allocations
+
+
+class GetQuotasTestCase(unittest.TestCase):
+
+    @mock.patch('hivemind_contrib.workers.time.sleep')
+    def test_not_found_and_errors(self, mock_sleep):
+        """Test that missing tenants aren't retried but transient errors
+        are.
+        """
+        def get_quotas(uuid):
+            if uuid == 'missing':
+                raise nova_exceptions.NotFound(404)
+            if uuid == 'broken':
+                raise IOError('Connection reset')
+            return 'quotas-%s' % uuid
+        nova_api = mock.Mock()
+        nova_api.quotas.get.side_effect = get_quotas
+
+        quotas, not_found, errors = allocations._get_quotas(
+            nova_api, ['t1', 'missing', 'broken'], concurrency=2, retries=3)
+        self.assertEqual(quotas, {'t1': 'quotas-t1'})
+        self.assertEqual(not_found, ['missing'])
+        self.assertEqual(errors.keys(), ['broken'])
+        self.assertEqual(
+            [c[0][0] for c in nova_api.quotas.get.call_args_list].count(
+                'broken'), 3)
+        self.assertEqual(
+            [c[0][0] for c in nova_api.quotas.get.call_args_list].count(
+                'missing'), 1)
+
+
+class CompareAllocationsTestCase(unittest.TestCase):
+
+    def test_compare_allocations(self):
+        allocations_ = {
+            't1': {'instance_quota': 2, 'core_quota': 4, 'ram_quota': 16},
+            't2': {'instance_quota': 1, 'core_quota': 2, 'ram_quota': 8},
+        }
+        quotas = {'t1': mock.Mock(instances=2, cores=8, ram=16384),
+                  't2': mock.Mock(instances=1, cores=2, ram=8192)}
+        usage = {'t2': {'instances': 1, 'vcpus': 2, 'ram': 16384}}
+        comparisons = {c.tenant_id: c for c in
+                       allocations.compare_allocations(allocations_,
+                                                       quotas, usage)}
+        self.assertEqual(comparisons['t1'].allocated,
+                         {'instances': 2, 'cores': 4, 'ram': 16384})
+        self.assertEqual(comparisons['t1'].quota_mismatches, ['cores'])
+        self.assertEqual(comparisons['t1'].over_quota, [])
+        self.assertEqual(comparisons['t2'].quota_mismatches, [])
+        self.assertEqual(comparisons['t2'].over_quota, ['ram'])
+
+
+class CompareQuotasTestCase(unittest.TestCase):
+
+    @mock.patch('hivemind_contrib.allocations.pretty_output')
+    @mock.patch('hivemind_contrib.allocations.allocation_store')
+    @mock.patch('hivemind_contrib.allocations._get_flavor_map')
+    @mock.patch('hivemind_contrib.allocations._resolve_tenants')
+    @mock.patch('hivemind_contrib.allocations.hm_nova.client')
+    @mock.patch('hivemind_contrib.allocations.hm_keystone.client_session')
+    def test_usage_only_for_mismatches(self, mock_keystone, mock_nova,
+                                       mock_resolve, mock_flavors,
+                                       mock_store, mock_output):
+        tenants = {}
+        for uuid in ('t1', 't2'):
+            tenants[uuid] = mock.Mock(id=uuid)
+            tenants[uuid].name = uuid
+        mock_resolve.return_value = tenants
+        mock_store.return_value.current_allocation.side_effect = \
+            lambda uuid: {'tenant_uuid': uuid, 'instance_quota': 2,
+                          'core_quota': 4, 'ram_quota': 16}
+        nova_api = mock_nova.return_value
+        nova_api.quotas.get.side_effect = lambda uuid: mock.Mock(
+            instances=2, cores=8 if uuid == 't1' else 4, ram=16384)
+        nova_api.servers.list.return_value = [mock.Mock(flavor={'id': 'f'})]
+        mock_flavors.return_value.fetch.return_value = []
+        mock_flavors.return_value.get.return_value = mock.Mock(vcpus=2,
+                                                               ram=1024)
+
+        with mock.patch('sys.stdout'):
+            allocations.compare_quotas('t1+t2')
+        nova_api.servers.list.assert_called_once_with(
+            search_opts={'project_id': 't1', 'tenant_id': 't1',
+                         'all_tenants': 1})
+        headings, rows = mock_output.call_args[0]
+        self.assertEqual(rows, [['t1', 't1', 'VCPU quota', 4, 8, 2]])
+
+
+class AllocationStoreTestCase(unittest.TestCase):
+
+    def _alloc(self, id, tenant, status, modified):
+        return {'id': id, 'tenant_uuid': tenant, 'status': status,
+                'modified_time': modified}
+
+    @mock.patch('hivemind_contrib.allocations.cache')
+    def test_incremental_refresh(self, mock_cache):
+        """Test that refresh merges the changed records by id and keeps
+        the current approved allocation of each tenant up to date.
+        """
+        mock_cache.load.return_value = None
+        api = mock.Mock(auth=('user', 'pass'), api_url='http://api')
+        api.iter_allocations.return_value = [
+            self._alloc(1, 't1', 'A', '2015-01-01'),
+            self._alloc(2, 't1', 'E', '2015-02-01'),
+            self._alloc(3, 't2', 'X', '2015-01-15')]
+        store = allocations.AllocationStore(api)
+        api.iter_allocations.assert_called_with(modified_since=None)
+        self.assertEqual(store.current_allocation('t1')['id'], 1)
+        self.assertEqual(store.current_allocation('t2')['id'], 3)
+        self.assertEqual(store.synced, '2015-02-01')
+
+        # The server may ignore the filter and send everything again.
+        api.iter_allocations.return_value = [
+            self._alloc(1, 't1', 'A', '2015-01-01'),
+            self._alloc(2, 't1', 'A', '2015-03-01'),
+            self._alloc(3, 't2', 'R', '2015-03-02')]
+        changed = store.refresh()
+        api.iter_allocations.assert_called_with(modified_since='2015-02-01')
+        self.assertEqual([alloc['id'] for alloc in changed], [2, 3])
+        self.assertEqual(store.current_allocation('t1')['id'], 2)
+        self.assertIsNone(store.current_allocation('t2'))
+        self.assertEqual(len(store.records), 3)
+        self.assertEqual([alloc['id'] for alloc in store.with_status('A')],
+                         [1, 2])
+        self.assertEqual(
+            [alloc['id'] for alloc in store.modified_since('2015-01-01')],
+            [2, 3])
+
+    @mock.patch('hivemind_contrib.allocations.cache')
+    def test_refresh_at_synced_time(self, mock_cache):
+        """Test that a record saved at the last synced time after the
+        sync is picked up, and the one already seen isn't reported again.
+        """
+        mock_cache.load.return_value = None
+        api = mock.Mock(auth=('user', 'pass'), api_url='http://api')
+        api.iter_allocations.return_value = [
+            self._alloc(1, 't1', 'A', '2015-02-01')]
+        store = allocations.AllocationStore(api)
+        api.iter_allocations.return_value = [
+            self._alloc(1, 't1', 'A', '2015-02-01'),
+            self._alloc(2, 't2', 'A', '2015-02-01')]
+        self.assertEqual([alloc['id'] for alloc in store.refresh()], [2])
+        self.assertEqual(store.current_allocation('t2')['id'], 2)
+
+
+class ReadNamesTestCase(unittest.TestCase):
+
+    def test_read_names(self):
+        """Test that names from the argument and the file are merged in
+        order without duplicates, blank lines or comments.
+        """
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write('# tenants\np2\n\n p3 \np1\n')
+            fp.flush()
+            self.assertEqual(allocations._read_names('p1+p2', fp.name),
+                             ['p1', 'p2', 'p3'])
+        self.assertEqual(allocations._read_names(None, None), [])
+
+
+class ReadDeltasTestCase(unittest.TestCase):
+
+    def test_last_row_wins(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write('id,tenant,cores,instances\n'
+                     '1,t1,2,1\n'
+                     '2,t2,4,2\n'
+                     '3,t1,8,4\n')
+            fp.flush()
+            with mock.patch('sys.stdout'):
+                deltas = allocations._read_deltas(fp.name, 1, 2, 3)
+        self.assertEqual(deltas.items(), [('t1', [8, 4]), ('t2', [4, 2])])
+
+
+class ReconcilerTestCase(unittest.TestCase):
+
+    def _server(self, id, tenant_id, flavor_id, status='ACTIVE'):
+        return mock.Mock(id=id, tenant_id=tenant_id, status=status,
+                         flavor={'id': flavor_id})
+
+    @mock.patch('hivemind_contrib.allocations.hm_nova.list_servers')
+    def test_poll(self, mock_list_servers):
+        """Test that only changed tenants are re-evaluated and that
+        mismatches are reported when they appear and are resolved.
+        """
+        store = mock.Mock()
+        store.refresh.return_value = []
+        store.current_allocations.return_value = {'t1': None, 't2': None}
+        store.current_allocation.return_value = {
+            'tenant_name': 'name', 'instance_quota': 2, 'core_quota': 4,
+            'ram_quota': 8}
+        nova_api = mock.Mock()
+        nova_api.quotas.get.return_value = mock.Mock(
+            instances=2, cores=4, ram=8192)
+        flavors = mock.Mock()
+        flavors.fetch.return_value = []
+        flavors.get.return_value = mock.Mock(vcpus=2, ram=1024)
+        reconciler = allocations.Reconciler(nova_api, store, flavors)
+
+        mock_list_servers.return_value = [
+            self._server('s1', 't1', 'f1'), self._server('s2', 't2', 'f1')]
+        self.assertEqual(reconciler.poll(), [])
+        self.assertNotIn('changes-since',
+                         mock_list_servers.call_args[1]['search_opts'])
+
+        mock_list_servers.return_value = [
+            self._server('s3', 't1', 'f1'), self._server('s4', 't1', 'f1')]
+        events = reconciler.poll()
+        self.assertIn('changes-since',
+                      mock_list_servers.call_args[1]['search_opts'])
+        self.assertEqual([(status, uuid) for status, uuid, c in events],
+                         [('mismatch', 't1')])
+        self.assertEqual(events[0][2].over_quota, ['instances', 'cores'])
+        self.assertEqual(nova_api.quotas.get.call_count, 2)
+
+        mock_list_servers.return_value = [
+            self._server('s4', 't1', 'f1', status='DELETED')]
+        self.assertEqual([(status, uuid) for status, uuid, c in
+                          reconciler.poll()], [('resolved', 't1')])
+        self.assertEqual(sorted(reconciler.servers), ['s1', 's2', 's3'])
+
+
+class ApplyReversionTestCase(unittest.TestCase):
+
+    row = {'Tenant ID': 't1', 'Instances': '2', 'vCPU quota': '4',
+           'Memory': '8192', 'Nova Instance quota': '4',
+           'Nova vCPU quota': '8', 'Nova Memory quota': '8192'}
+
+    def test_update(self):
+        nova_api = mock.Mock()
+        nova_api.quotas.get.return_value = mock.Mock(
+            instances=4, cores=8, ram=8192)
+        self.assertEqual(allocations._apply_reversion(nova_api, self.row),
+                         ('t1', 'updated', ''))
+        nova_api.quotas.update.assert_called_once_with(
+            't1', instances=2, cores=4, ram=8192)
+
+    def test_already_updated(self):
+        nova_api = mock.Mock()
+        nova_api.quotas.get.return_value = mock.Mock(
+            instances=2, cores=4, ram=8192)
+        self.assertEqual(allocations._apply_reversion(nova_api, self.row),
+                         ('t1', 'updated', ''))
+        self.assertFalse(nova_api.quotas.update.called)
+
+    def test_changed_since_plan(self):
+        nova_api = mock.Mock()
+        nova_api.quotas.get.return_value = mock.Mock(
+            instances=6, cores=8, ram=8192)
+        self.assertEqual(allocations._apply_reversion(nova_api, self.row),
+                         ('t1', 'skipped - quotas changed', ''))
+        self.assertFalse(nova_api.quotas.update.called)
@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from hivemind_contrib import cache
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(cache, 'CACHE_DIR', self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        cache.save('users', [{'id': 'u1', 'email': 'a@example.com'}])
+        self.assertEqual(cache.load('users', ttl=60),
+                         [{'id': 'u1', 'email': 'a@example.com'}])
+
+    def test_missing(self):
+        self.assertEqual(cache.load('projects'), None)
+
+    @mock.patch('time.time')
+    def test_expired(self, mock_time):
+        mock_time.return_value = 1000
+        cache.save('projects', [])
+        mock_time.return_value = 1100
+        self.assertEqual(cache.load('projects', ttl=200), [])
+        self.assertEqual(cache.load('projects', ttl=50), None)
+        self.assertEqual(cache.load('projects'), [])
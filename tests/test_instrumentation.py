@@ -0,0 +1,75 @@
+import unittest
+
+import mock
+
+from hivemind_contrib import instrumentation
+
+
+class Manager(object):
+
+    def list(self):
+        return ['a', 'b']
+
+    def iterate(self):
+        yield 1
+        yield 2
+
+
+class Client(object):
+    name = 'client'
+
+    def __init__(self):
+        self.servers = Manager()
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = instrumentation.Recorder()
+        patcher = mock.patch.object(instrumentation, 'recorder',
+                                    self.recorder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(instrumentation, 'SETTING', '')
+    def test_disabled(self):
+        client = Client()
+        self.assertIs(instrumentation.wrap(client, 'nova'), client)
+
+    @mock.patch.object(instrumentation, '_install')
+    @mock.patch.object(instrumentation, 'SETTING', '1')
+    def test_proxy(self, mock_install):
+        """Test that calls through managers are recorded, with the time
+        spent iterating over a returned generator counted as one call.
+        """
+        client = instrumentation.wrap(Client(), 'nova')
+        self.assertEqual(client.name, 'client')
+        self.assertEqual(client.servers.list(), ['a', 'b'])
+        self.assertEqual(client.servers.list(), ['a', 'b'])
+        self.assertEqual(list(client.servers.iterate()), [1, 2])
+        calls = self.recorder.to_dict()
+        self.assertEqual(sorted(calls), ['nova servers iterate',
+                                         'nova servers list'])
+        self.assertEqual(calls['nova servers list']['count'], 2)
+        self.assertEqual(calls['nova servers iterate']['count'], 1)
+        self.assertEqual(calls['nova servers list']['histogram'],
+                         {'<=0.01s': 2})
+
+    def test_send(self):
+        """Test that response sizes are counted against the current call,
+        or the host when there isn't one.
+        """
+        response = mock.Mock(headers={'Content-Length': '100'})
+        response.elapsed.total_seconds.return_value = 0.2
+        request = mock.Mock(url='http://nova:8774/v2/servers',
+                            method='GET')
+        with mock.patch.object(instrumentation, '_original_send',
+                               return_value=response):
+            instrumentation._send(None, request)
+            self.recorder.call(('nova servers', 'list'),
+                               instrumentation._send, None, request)
+        calls = self.recorder.to_dict()
+        self.assertEqual(calls['http nova:8774 GET']['bytes'], 100)
+        self.assertEqual(calls['http nova:8774 GET']['histogram'],
+                         {'<=0.25s': 1})
+        self.assertEqual(calls['nova servers list']['bytes'], 100)
@@ -0,0 +1,297 @@
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from hivemind_contrib import keystone
+from hivemind_contrib import nova
+
+
+CREDENTIALS = {'url': 'http://keystone:5000/v2.0', 'username': 'user',
+               'password': 'secret', 'tenant': 'admin'}
+
+
+@mock.patch.dict('os.environ', clear=True)
+@mock.patch.dict(keystone._registry, clear=True)
+class SharedClientsTestCase(unittest.TestCase):
+
+    @mock.patch('hivemind_contrib.keystone.keystone_client_v3.Client')
+    @mock.patch('hivemind_contrib.keystone.keystone_session.Session')
+    def test_client_session_is_shared(self, mock_session, mock_client):
+        mock_session.side_effect = lambda **kwargs: mock.Mock()
+        mock_client.side_effect = lambda **kwargs: mock.Mock()
+        first = keystone.client_session(version=3, **CREDENTIALS)
+        second = keystone.client_session(version=3, **CREDENTIALS)
+        self.assertIs(first, second)
+        self.assertEqual(mock_session.call_count, 1)
+        self.assertEqual(mock_client.call_count, 1)
+
+        other = dict(CREDENTIALS, username='other')
+        self.assertIsNot(keystone.client_session(version=3, **other), first)
+
+    def test_slow_factory_does_not_block_other_keys(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        thread = threading.Thread(target=keystone.shared,
+                                  args=('slow', slow))
+        thread.start()
+        started.wait(5)
+        try:
+            self.assertEqual(keystone.shared('fast', lambda: 'fast'),
+                             'fast')
+            self.assertFalse(release.is_set())
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(keystone.shared('slow', lambda: 'again'), 'slow')
+
+    @mock.patch('hivemind_contrib.nova.nova_client.Client')
+    @mock.patch('hivemind_contrib.keystone.keystone_client.Client')
+    @mock.patch('hivemind_contrib.keystone.keystone_identity.v2.Password')
+    def test_nova_shares_the_token(self, mock_password, mock_keystone,
+                                   mock_nova):
+        """Test that keystone and nova sessions share one auth plugin,
+        even when they have different timeouts.
+        """
+        keystone.client_session(**CREDENTIALS)
+        nova.client(**CREDENTIALS)
+        nova.client(timeout=60, **CREDENTIALS)
+        self.assertIs(nova.client(**CREDENTIALS), nova.client(**CREDENTIALS))
+        self.assertEqual(mock_password.call_count, 1)
+        self.assertEqual(mock_nova.call_count, 2)
+        sessions = [c[1]['session'] for c in mock_nova.call_args_list]
+        self.assertIs(sessions[0], mock_keystone.call_args[1]['session'])
+        self.assertEqual(sessions[1].timeout, 60)
+        self.assertIs(sessions[0].auth, sessions[1].auth)
+
+
+class BulkMetadataTestCase(unittest.TestCase):
+
+    def test_read_metadata(self):
+        with tempfile.NamedTemporaryFile(suffix='.jsonl') as fp:
+            fp.write('{"entity": "p1", "key": "vicnode_id", "value": "3"}\n'
+                     '\n'
+                     '{"entity": "u1", "key": "k", "value": "v", '
+                     '"type": "user", "mode": "append"}\n')
+            fp.flush()
+            rows = list(keystone._read_metadata(fp.name))
+        self.assertEqual(rows, [
+            {'entity': 'p1', 'key': 'vicnode_id', 'value': '3',
+             'type': 'project', 'mode': 'set'},
+            {'entity': 'u1', 'key': 'k', 'value': 'v',
+             'type': 'user', 'mode': 'append'}])
+
+    @mock.patch('hivemind_contrib.workers.time.sleep')
+    def test_apply_metadata(self, mock_sleep):
+        """Test that appends add to the current list once, and that a
+        failing update doesn't stop the rest.
+        """
+        project = mock.Mock()
+        project.to_dict.return_value = {'allocation_home': 'uni-a'}
+        manager = mock.Mock()
+        manager.get.return_value = project
+
+        def update(entity_id, **kwargs):
+            if kwargs.get('vicnode_id') == 'bad':
+                raise IOError('bad')
+            project.to_dict.return_value = kwargs
+            return project
+        manager.update.side_effect = update
+        rows = [
+            {'key': 'allocation_home', 'value': 'uni-b', 'mode': 'append'},
+            {'key': 'allocation_home', 'value': 'uni-b', 'mode': 'append'},
+            {'key': 'vicnode_id', 'value': 'bad', 'mode': 'set'},
+            {'key': 'vicnode_id', 'value': '3', 'mode': 'set'}]
+        results = keystone._apply_metadata(manager, 'p1', rows)
+        self.assertEqual([status for status, error in results],
+                         ['updated', 'unchanged', 'failed', 'updated'])
+        manager.update.assert_any_call('p1', allocation_home='uni-a,uni-b')
+        self.assertEqual(manager.get.call_count, 1)
+
+
+class PrintMembersTestCase(unittest.TestCase):
+
+    @mock.patch.dict(keystone._role_names, clear=True)
+    @mock.patch('hivemind_contrib.keystone.client')
+    def test_print_members(self, mock_client):
+        """Test that roles come from one effective assignment listing,
+        that the role names are only fetched once, and that a role a user
+        has more than once (such as through a group) is shown once.
+        """
+        def role(id, name):
+            role = mock.Mock(id=id)
+            role.name = name
+            return role
+
+        def assignment(user_id, role_id):
+            return mock.Mock(user={'id': user_id}, role={'id': role_id})
+
+        keystone_api = mock_client.return_value
+        keystone_api.roles.list.return_value = [role('1', 'Member'),
+                                                role('2', 'TenantManager')]
+        keystone_api.role_assignments.list.return_value = [
+            assignment('u1', '1'), assignment('u1', '2'),
+            assignment('u2', '1'), assignment('u1', '1')]
+        tenant = mock.Mock(id='t1')
+        tenant.list_users.return_value = [
+            mock.Mock(id='u1', email='u1@example.com'),
+            mock.Mock(id='u2', email='u2@example.com')]
+
+        with mock.patch('sys.stdout') as stdout:
+            keystone.print_members(tenant)
+            keystone.print_members(tenant)
+        output = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertIn('| u1 | u1@example.com | Member, TenantManager |',
+                      output)
+        self.assertIn('| u2 | u2@example.com |         Member        |',
+                      output)
+        keystone_api.role_assignments.list.assert_called_with(
+            project='t1', effective=True)
+        self.assertEqual(keystone_api.roles.list.call_count, 1)
+
+
+class UserProjectsTestCase(unittest.TestCase):
+
+    @mock.patch.dict(keystone._registry, clear=True)
+    @mock.patch.dict(keystone._role_names, {'1': 'Member'}, clear=True)
+    @mock.patch('hivemind_contrib.keystone.client')
+    def test_shared_project_lookups(self, mock_client):
+        """Test that only the projects users have roles in are fetched,
+        once each, and that unknown users are reported.
+        """
+        def get_user(name_or_id):
+            if name_or_id == 'nobody':
+                raise keystone.NotFound()
+            user = mock.Mock(id=name_or_id)
+            user.name = name_or_id
+            return user
+
+        def assignments(user):
+            return [mock.Mock(scope={'project': {'id': 'p1'}},
+                              role={'id': '1'}),
+                    mock.Mock(scope={'domain': {'id': 'd1'}},
+                              role={'id': '1'}),
+                    mock.Mock(scope={'project': {'id': 'p-' + user.id}},
+                              role={'id': '1'})]
+
+        keystone_api = mock_client.return_value
+        keystone_api.users.get.side_effect = get_user
+        keystone_api.users.find.side_effect = keystone.NotFound()
+        keystone_api.role_assignments.list.side_effect = \
+            lambda user: assignments(user)
+        keystone_api.projects.get.side_effect = \
+            lambda project_id: mock.Mock(id=project_id)
+
+        with mock.patch('sys.stdout') as stdout:
+            keystone.user_projects('u1+u2+nobody', concurrency=2)
+        output = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertIn('Unknown user nobody', output)
+        self.assertIn('Projects and roles for user u2:', output)
+        self.assertEqual(
+            sorted(c[0][0] for c in keystone_api.projects.get.call_args_list),
+            ['p-u1', 'p-u2', 'p1'])
+        self.assertFalse(keystone_api.projects.list.called)
+
+
+class ResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = mock.Mock()
+        self.resources = {}
+        for i in range(3):
+            resource = mock.Mock(id='id%d' % i)
+            resource.name = 'name%d' % i
+            self.resources[resource.id] = resource
+
+        def get(id):
+            if id not in self.resources:
+                raise keystone.NotFound()
+            return self.resources[id]
+
+        def find(name):
+            for resource in self.resources.values():
+                if resource.name == name:
+                    return resource
+            raise keystone.NotFound()
+
+        self.manager.get.side_effect = get
+        self.manager.find.side_effect = find
+        self.manager.list.side_effect = lambda: self.resources.values()
+
+    def test_cache(self):
+        """Test that names, ids and unknown names are remembered."""
+        resolver = keystone.Resolver(self.manager)
+        self.assertEqual(resolver.resolve('name1').id, 'id1')
+        self.assertEqual(resolver.resolve('name1').id, 'id1')
+        self.assertEqual(resolver.resolve('id2').name, 'name2')
+        self.assertRaises(keystone.NotFound, resolver.resolve, 'nobody')
+        self.assertRaises(keystone.NotFound, resolver.resolve, 'nobody')
+        self.assertEqual(self.manager.get.call_count, 3)
+        self.assertEqual(self.manager.find.call_count, 2)
+
+    def test_lru_and_ttl(self):
+        """Test that the least recently used and expired entries are
+        looked up again.
+        """
+        resolver = keystone.Resolver(self.manager, size=2)
+        resolver.resolve('id0')
+        resolver.resolve('id1')
+        resolver.resolve('id0')
+        resolver.resolve('id2')
+        self.manager.get.reset_mock()
+        resolver.resolve('id0')
+        self.assertFalse(self.manager.get.called)
+        resolver.resolve('id1')
+        self.assertEqual(self.manager.get.call_count, 1)
+
+        resolver = keystone.Resolver(self.manager, ttl=10)
+        with mock.patch('time.time', return_value=100):
+            resolver.resolve('id0')
+        with mock.patch('time.time', return_value=111):
+            resolver.resolve('id0')
+        self.assertEqual(self.manager.get.call_count, 3)
+
+    @mock.patch.dict(keystone._registry, clear=True)
+    def test_forget(self):
+        """Test that updating a resource drops it, and the names that
+        weren't found, from every shared resolver.
+        """
+        resolver = keystone.shared('resolver', lambda: keystone.Resolver(
+            self.manager))
+        resolver.resolve('name0')
+        resolver.resolve('name1')
+        self.assertRaises(keystone.NotFound, resolver.resolve, 'nobody')
+        keystone.forget('id0')
+        resolver.resolve('name0')
+        resolver.resolve('name1')
+        self.assertRaises(keystone.NotFound, resolver.resolve, 'nobody')
+        self.assertEqual(self.manager.find.call_count, 5)
+
+    def test_resolve_many(self):
+        """Test that small batches are looked up one by one and large ones
+        with a single listing, with None for unknown and ambiguous names.
+        """
+        duplicate = mock.Mock(id='id3')
+        duplicate.name = 'name0'
+        self.resources['id3'] = duplicate
+
+        resolver = keystone.Resolver(self.manager, bulk_threshold=3)
+        results = resolver.resolve_many(['id1', 'nobody'], retries=1)
+        self.assertEqual(results.keys(), ['id1', 'nobody'])
+        self.assertEqual(results['id1'].name, 'name1')
+        self.assertIsNone(results['nobody'])
+        self.assertFalse(self.manager.list.called)
+
+        results = resolver.resolve_many(['name0', 'id1', 'name2', 'id3',
+                                         'nobody', 'other'])
+        self.assertEqual(self.manager.list.call_count, 1)
+        self.assertEqual([r and r.id for r in results.values()],
+                         [None, 'id1', 'id2', 'id3', None, None])
+        self.assertEqual(self.manager.get.call_count, 2)
@@ -0,0 +1,101 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from hivemind_contrib import ledger
+
+
+def tenant_usage(tenant_id, *server_usages):
+    return mock.Mock(tenant_id=tenant_id,
+                     server_usages=list(server_usages),
+                     total_hours=sum(iu['hours'] for iu in server_usages),
+                     total_vcpus_usage=sum(iu['hours'] * iu['vcpus']
+                                           for iu in server_usages),
+                     total_memory_mb_usage=0,
+                     total_local_gb_usage=0)
+
+
+def server_usage(instance_id, state, hours):
+    return {'instance_id': instance_id, 'name': instance_id,
+            'state': state, 'flavor': 'm1.small', 'hours': hours,
+            'vcpus': 2, 'memory_mb': 4096, 'local_gb': 10}
+
+
+class UsageLedgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ledger = ledger.UsageLedger(
+            os.path.join(self.tmpdir, 'usage.sqlite'))
+        self.nova = mock.Mock()
+        self.nova.usage.list.side_effect = lambda start, end, detailed: [
+            tenant_usage('t1', server_usage('i1', 'active', 24.0)),
+            tenant_usage('t2', server_usage('i2', 'active', 24.0),
+                         server_usage('i3', 'terminated', 3.0))]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync_only_fetches_missing_days(self):
+        start = datetime.date(2015, 1, 1)
+        locate = lambda tenant_id, iu: 'az1'
+        self.assertEqual(
+            self.ledger.sync(self.nova, start, datetime.date(2015, 1, 3),
+                             locate), 2)
+        self.assertEqual(
+            self.ledger.sync(self.nova, start, datetime.date(2015, 1, 4),
+                             locate), 1)
+        self.assertEqual(self.nova.usage.list.call_count, 3)
+
+    def test_totals(self):
+        start = datetime.date(2015, 1, 1)
+        end = datetime.date(2015, 1, 3)
+        self.ledger.sync(self.nova, start, end, lambda tenant_id, iu: 'az1')
+        self.assertEqual(list(self.ledger.tenant_totals(start, end)),
+                         [('t1', 1, 48.0, 96.0, 0.0, 0.0),
+                          ('t2', 2, 54.0, 108.0, 0.0, 0.0)])
+        instances = list(self.ledger.instance_totals(start, end))
+        self.assertEqual([(iu['instance_id'], iu['hours'])
+                          for iu in instances],
+                         [('i1', 48.0), ('i2', 48.0), ('i3', 6.0)])
+        self.assertEqual(instances[0]['availability_zone'], 'az1')
+
+    def test_locate_instances_later(self):
+        """Test that zones left out by sync are filled in once, looking
+        instances deleted on any day up as deleted.
+        """
+        start = datetime.date(2015, 1, 1)
+        end = datetime.date(2015, 1, 3)
+        self.ledger.sync(self.nova, start, end)
+        instances = list(self.ledger.instance_totals(start, end))
+        self.assertEqual([iu['availability_zone'] for iu in instances],
+                         [None, None, None])
+
+        locate = mock.Mock(side_effect=lambda tenant_id, iu: iu['state'])
+        self.assertEqual(self.ledger.locate_instances(start, end, locate),
+                         3)
+        self.assertEqual(self.ledger.locate_instances(start, end, locate),
+                         0)
+        self.assertEqual(locate.call_count, 3)
+        instances = list(self.ledger.instance_totals(start, end))
+        self.assertEqual([iu['availability_zone'] for iu in instances],
+                         ['active', 'active', 'terminated'])
+
+    def test_zones_not_found_are_retried(self):
+        start = datetime.date(2015, 1, 1)
+        end = datetime.date(2015, 1, 2)
+        self.ledger.sync(self.nova, start, end)
+        locate = lambda tenant_id, iu: \
+            'az1' if iu['instance_id'] == 'i1' else None
+        self.assertEqual(self.ledger.locate_instances(start, end, locate),
+                         1)
+        self.assertEqual(self.ledger.locate_instances(start, end, locate),
+                         0)
+        self.assertEqual(
+            [iu['availability_zone']
+             for iu in self.ledger.instance_totals(start, end)],
+            ['az1', None, None])
@@ -1,6 +1,12 @@
+import shutil
+import tempfile
+import unittest
+
 import hivemind.decorators
+import mock
 import mox
 
+from hivemind_contrib import cache
 from hivemind_contrib import nova
 
 
@@ -82,3 +88,75 @@ class NovaTestCase(mox.MoxTestBase):
         nova.disable_host_services("banana")
 
         self.mox.VerifyAll()
+
+
+class FakeFlavor(object):
+
+    def __init__(self, manager, info, loaded=False):
+        self._info = info
+        self.id = info['id']
+        self.name = info['name']
+
+    def to_dict(self):
+        return dict(self._info)
+
+
+class FlavorCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(cache, 'CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        self.client = mock.Mock()
+        self.client.client = mock.Mock(
+            spec=['auth_url'], auth_url='http://keystone:5000/v2.0')
+        flavors = self.client.flavors
+        flavors.resource_class = FakeFlavor
+        flavors.list.side_effect = lambda is_public: [
+            FakeFlavor(flavors, info) for info in
+            ([{'id': 'new', 'name': 'm1.small'}] if is_public else
+             [{'id': 'private', 'name': 'm1.small'}])]
+        flavors.get.side_effect = lambda flavor_id: FakeFlavor(
+            flavors, {'id': flavor_id, 'name': 'm1.small'})
+
+    def test_names_of_live_public_flavors_win(self):
+        """Test that neither private nor fetched deleted flavors shadow a
+        public flavor's name, even once they are in the cache.
+        """
+        flavors = nova.FlavorCache(self.client)
+        self.assertEqual(flavors.fetch(['old']), [])
+        self.assertEqual(flavors['old'].name, 'm1.small')
+        self.assertEqual(nova.get_flavor_id(self.client, 'm1.small'), 'new')
+        self.assertIn('old', nova.FlavorCache(self.client))
+        self.assertEqual(self.client.flavors.list.call_count, 2)
+
+    def test_fetch_nothing_missing(self):
+        flavors = nova.FlavorCache(self.client)
+        with mock.patch('hivemind_contrib.workers.imap') as imap:
+            self.assertEqual(flavors.fetch(['new', 'private']), [])
+        self.assertFalse(imap.called)
+
+
+class ListServersTestCase(unittest.TestCase):
+
+    def test_pages(self):
+        """Test that pages are fetched with the last id of the previous
+        page as the marker until an empty page comes back.
+        """
+        pages = [[mock.Mock(id='s1'), mock.Mock(id='s2')],
+                 [mock.Mock(id='s3')], []]
+        client = mock.Mock()
+        client.servers.list.side_effect = pages
+        servers = list(nova.list_servers(client, {'all_tenants': 1},
+                                         page_size=2))
+        self.assertEqual([server.id for server in servers],
+                         ['s1', 's2', 's3'])
+        self.assertEqual(
+            [c[1]['marker'] for c in client.servers.list.call_args_list],
+            [None, 's2', 's3'])
+        client.servers.list.assert_called_with(
+            detailed=True, search_opts={'all_tenants': 1}, marker='s3',
+            limit=2)
@@ -0,0 +1,256 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from novaclient import exceptions as nova_exceptions
+
+from hivemind_contrib import cache
+from hivemind_contrib import reporting
+
+
+class CsvOutputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_csv_output_gzip(self):
+        """Test that rows from a generator are written to a gzip file."""
+        filename = os.path.join(self.tmpdir, 'usage.csv.gz')
+        rows = ([i, u'tenant-%s' % i] for i in range(3))
+        reporting.csv_output(['ID', 'Name'], rows, filename=filename)
+        with gzip.open(filename, 'rb') as fp:
+            self.assertEqual(fp.read().splitlines(),
+                             ['ID,Name', '0,tenant-0', '1,tenant-1',
+                              '2,tenant-2'])
+
+    def test_csv_output_plain(self):
+        filename = os.path.join(self.tmpdir, 'usage.csv')
+        reporting.csv_output(['ID'], iter([[1]]), filename=filename)
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read().splitlines(), ['ID', '1'])
+
+
+class SplitPeriodTestCase(unittest.TestCase):
+
+    def test_split_period_week(self):
+        start = datetime.datetime(2015, 1, 1)
+        end = datetime.datetime(2015, 1, 20, 12, 30)
+        self.assertEqual(
+            list(reporting._split_period(start, end, 'week')),
+            [(start, datetime.datetime(2015, 1, 8)),
+             (datetime.datetime(2015, 1, 8), datetime.datetime(2015, 1, 15)),
+             (datetime.datetime(2015, 1, 15), end)])
+
+    def test_split_period_days(self):
+        start = datetime.datetime(2015, 1, 1)
+        end = datetime.datetime(2015, 1, 2)
+        self.assertEqual(
+            list(reporting._split_period(start, end, '0.5')),
+            [(start, datetime.datetime(2015, 1, 1, 12)),
+             (datetime.datetime(2015, 1, 1, 12), end)])
+
+
+class DeletedInstancesTestCase(unittest.TestCase):
+
+    def test_get_deleted_instances(self):
+        """Test that every page of the changes-since sweep is indexed."""
+        def server(id, az):
+            return mock.Mock(id=id, **{'OS-EXT-AZ:availability_zone': az})
+        nova = mock.Mock()
+        nova.servers.list.side_effect = [
+            [server('i1', 'az1'), server('i2', 'az2')], [server('i3', 'az1')],
+            []]
+        deleted = reporting._get_deleted_instances(
+            nova, datetime.datetime(2015, 1, 1), page_size=2)
+        self.assertEqual(deleted, {'i1': 'az1', 'i2': 'az2', 'i3': 'az1'})
+        self.assertEqual(
+            [c[1]['marker'] for c in nova.servers.list.call_args_list],
+            [None, 'i2', 'i3'])
+        self.assertEqual(nova.servers.list.call_args[1]['search_opts'],
+                         {'deleted': True, 'all_tenants': True,
+                          'changes-since': '2015-01-01T00:00:00'})
+
+    @mock.patch('hivemind_contrib.workers.time.sleep')
+    def test_failed_sweep(self, mock_sleep):
+        """Test that a sweep that keeps failing is retried, then leaves
+        deleted instances in an unknown zone without being tried again.
+        """
+        nova = mock.Mock()
+        nova.servers.list.side_effect = IOError('Connection reset')
+        locate = reporting._instance_locator(
+            nova, mock.Mock(), datetime.datetime(2015, 1, 1))
+        with mock.patch('sys.stdout'):
+            for instance_id in ('i1', 'i2'):
+                self.assertEqual(
+                    locate('t1', {'instance_id': instance_id,
+                                  'state': 'terminated'}), 'unknown')
+        self.assertEqual(nova.servers.list.call_count, 3)
+
+    def test_live_instance_deleted_since(self):
+        """Test that an instance recorded as active that nova no longer
+        has is looked for among the deleted ones.
+        """
+        nova = mock.Mock()
+        nova.servers.get.side_effect = nova_exceptions.NotFound(404)
+        nova.servers.list.side_effect = [
+            [mock.Mock(id='i1', **{'OS-EXT-AZ:availability_zone': 'az1'})],
+            []]
+        locate = reporting._instance_locator(
+            nova, mock.Mock(), datetime.datetime(2015, 1, 1), default=None)
+        with mock.patch('sys.stdout'):
+            self.assertEqual(
+                locate('t1', {'instance_id': 'i1', 'state': 'active'}),
+                'az1')
+            self.assertIsNone(
+                locate('t1', {'instance_id': 'i2', 'state': 'active'}))
+        self.assertEqual(nova.servers.list.call_count, 2)
+
+
+def response(body, status_code=200, headers=None):
+    resp = mock.Mock(status_code=status_code, headers=headers or {})
+    resp.json.return_value = body
+    return resp
+
+
+class NectarApiSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(cache, 'CACHE_DIR', self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = reporting.NectarApiSession(
+            'http://api', 'user', 'secret')
+        patcher = mock.patch.object(self.session, 'get')
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_revalidate(self):
+        """Test that a cached listing is revalidated with its ETag and
+        Last-Modified, and that a 304 returns the cached body.
+        """
+        self.get.return_value = response(
+            [{'id': 1}], headers={'ETag': '"v1"',
+                                  'Last-Modified': 'Thu, 01 Jan 2015'})
+        self.assertEqual(self.session.get_quotas(), [{'id': 1}])
+        self.get.assert_called_with('http://api/rest_api/quotas',
+                                    headers={})
+
+        self.get.return_value = response(None, status_code=304)
+        self.assertEqual(self.session.get_quotas(), [{'id': 1}])
+        self.get.assert_called_with(
+            'http://api/rest_api/quotas',
+            headers={'If-None-Match': '"v1"',
+                     'If-Modified-Since': 'Thu, 01 Jan 2015'})
+
+    def test_pagination(self):
+        """Test that 'next' links are followed until there are none."""
+        self.get.side_effect = [
+            response({'results': [{'id': 1}, {'id': 2}],
+                      'next': 'http://api/rest_api/allocations?page=2'}),
+            response({'results': [{'id': 3}], 'next': None})]
+        self.assertEqual([a['id'] for a in self.session.get_allocations()],
+                         [1, 2, 3])
+        self.assertEqual([c[0][0] for c in self.get.call_args_list],
+                         ['http://api/rest_api/allocations',
+                          'http://api/rest_api/allocations?page=2'])
+
+    def test_filtered_listing_is_not_cached(self):
+        self.get.return_value = response(
+            [{'id': 1}], headers={'ETag': '"v1"'})
+        self.assertEqual(
+            list(self.session.iter_allocations('2015-01-01T00:00:00')),
+            [{'id': 1}])
+        self.get.assert_called_once_with(
+            'http://api/rest_api/allocations?'
+            'modified_time__gte=2015-01-01T00%3A00%3A00')
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class LedgerDaysTestCase(unittest.TestCase):
+
+    def test_end_rounded_up(self):
+        """Test that a partial last day is kept in the ledger range."""
+        self.assertEqual(
+            reporting._ledger_days(datetime.datetime(2015, 1, 1, 10, 0),
+                                   datetime.datetime(2015, 1, 31, 23, 59)),
+            (datetime.date(2015, 1, 1), datetime.date(2015, 2, 1)))
+        self.assertEqual(
+            reporting._ledger_days(datetime.datetime(2015, 1, 1),
+                                   datetime.datetime(2015, 2, 1)),
+            (datetime.date(2015, 1, 1), datetime.date(2015, 2, 1)))
+
+
+class AllocationContactsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        def project(id, **kwargs):
+            proj = mock.Mock(id=id, **kwargs)
+            proj.to_dict.return_value = dict(id=id, **kwargs)
+            return proj
+        self.directory = mock.Mock()
+        self.directory.user_emails.return_value = {'u1': 'a@uni.edu.au'}
+        self.directory.project_managers.return_value = {'p1': ['u1'],
+                                                        'p3': ['u1']}
+        self.directory.projects.return_value = [
+            project('p1'), project('p2'),
+            project('p3', allocation_home='other.edu.au')]
+
+    def test_homes(self):
+        self.assertEqual(
+            list(reporting._allocation_contacts(self.directory, ['homes'])),
+            [['p1', 'uni.edu.au'], ['p3', 'other.edu.au']])
+
+    def test_homes_and_managers(self):
+        self.assertEqual(
+            list(reporting._allocation_contacts(self.directory,
+                                                ['managers', 'homes'])),
+            [['p1', 'a@uni.edu.au', 'uni.edu.au'],
+             ['p3', 'a@uni.edu.au', 'other.edu.au']])
+
+
+class CrosstabTestCase(unittest.TestCase):
+
+    def test_crosstab(self):
+        table = reporting.Crosstab(default=0)
+        table.add('a1', 'melbourne-cores', 10)
+        table.add('a2', 'monash-cores', 20)
+        table.add('a1', 'monash-cores', 30)
+        table.add('a2', 'qld-ram', 40)
+        self.assertEqual(table.columns,
+                         ['melbourne-cores', 'monash-cores', 'qld-ram'])
+        self.assertEqual(list(table),
+                         [('a1', [10, 30, 0]), ('a2', [0, 20, 40])])
+
+
+class UsageRollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rollup = reporting.UsageRollup()
+        self.rollup.add('melbourne', 'm1.small', 't1', 10, 1, 4096, 10)
+        self.rollup.add('melbourne', 'm1.small', 't1', 5, 1, 4096, 10)
+        self.rollup.add('melbourne', 'm1.large', 't2', 2.5, 4, 16384, 30)
+        self.rollup.add('monash', 'm1.small', 't2', 1, 1, 4096, 10)
+
+    def test_summary_by_az(self):
+        self.assertEqual(
+            list(self.rollup.summary(['az'])),
+            [['melbourne', 3, 17.5, 25.0, 102400.0, 225.0],
+             ['monash', 1, 1.0, 1.0, 4096.0, 10.0]])
+
+    def test_summary_by_flavor_and_tenant(self):
+        self.assertEqual(
+            list(self.rollup.summary(['flavor', 'tenant'])),
+            [['m1.large', 't2', 1, 2.5, 10.0, 40960.0, 75.0],
+             ['m1.small', 't1', 2, 15.0, 15.0, 61440.0, 150.0],
+             ['m1.small', 't2', 1, 1.0, 1.0, 4096.0, 10.0]])
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from hivemind_contrib import workers
+
+
+def test_imap_preserves_order():
+    def slow_square(x):
+        time.sleep(0.01 * (5 - x))
+        return x * x
+    assert list(workers.imap(slow_square, range(5), 4)) == [0, 1, 4, 9, 16]
+
+
+def test_imap_serial():
+    threads = set()
+
+    def record(x):
+        threads.add(threading.current_thread())
+        return x
+    assert list(workers.imap(record, range(3))) == [0, 1, 2]
+    assert threads == set([threading.current_thread()])
+
+
+def test_rate_limiter():
+    limiter = workers.RateLimiter(50)
+    start = time.time()
+    for i in range(6):
+        limiter.wait()
+    assert time.time() - start >= 0.1
+
+
+def test_rate_limiter_disabled():
+    limiter = workers.RateLimiter(None)
+    start = time.time()
+    for i in range(100):
+        limiter.wait()
+    assert time.time() - start < 0.1
+
+
+def test_retry():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError()
+        return 'done'
+    assert workers.retry(flaky, attempts=3, delay=0) == 'done'
+    assert len(calls) == 3
+
+
+def test_retry_gives_up():
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise IOError()
+    try:
+        workers.retry(broken, attempts=2, delay=0)
+    except IOError:
+        pass
+    else:
+        assert False, 'IOError not raised'
+    assert len(calls) == 2